@@ -0,0 +1,56 @@
+import tracemalloc
+
+PATHS = {'weight array': dict(separable=False, fused=False), # full weight array times the term, then int_arr
+         'separable': dict(separable=True, fused=False), # term product integrated against the separable weight factors
+         'fused': dict(separable=True, fused=True)} # fused_integral over the primes and separable weight factors
+
+def benchmark_allocations(dataset, irrep, by_parts=True, domains=None): # memory use of the integration kernel
+    # returns {path: bytes} for each path in PATHS: temporary bytes allocated per Q entry by eval_on_domain, i.e. the
+    # peak traced (tracemalloc) allocation of each integrated term, summed over the integrated terms and divided by
+    # the number of entries; primes are evaluated beforehand and not counted
+    # tracemalloc only sees allocations made through Python's allocators, not numba's NRT allocations, so the
+    # 'fused' numbers leave out any arrays allocated inside the numba kernel
+    # dataset: AbstractDataset with libraries, domains and weights; domains: domains to evaluate on (default: the first)
+    plan = dataset.get_plan(irrep, by_parts)
+    plan_weights = plan.make_weights(dataset.weights)
+    domains = dataset.domains[:1] if domains is None else domains
+    fields = {domain: dataset.eval_fields(plan.primes(), domain) for domain in domains}
+    entries = [(primes, weight, domain) for column, column_weights in zip(plan.entries, plan_weights)
+               for (primes, k, coeff, row), weight in zip(column, column_weights) for domain in domains]
+    started = not tracemalloc.is_tracing()
+    result = dict()
+    for path, options in PATHS.items():
+        for primes, weight, domain in entries: # warm up the weight cache
+            dataset.eval_on_domain(primes, weight, domain, fields=fields[domain], **options)
+        if started:
+            tracemalloc.start()
+        total = 0
+        for primes, weight, domain in entries:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            dataset.eval_on_domain(primes, weight, domain, fields=fields[domain], **options)
+            total += tracemalloc.get_traced_memory()[1] - before
+        if started:
+            tracemalloc.stop()
+        result[path] = total / (plan.n_rows * len(plan.terms) * len(domains))
+    return result
+
+if __name__ == '__main__': # decaying Taylor-Green vortex on a 48 x 48 x 24 grid
+    import numpy as np
+    from PySPIDER.commons.library import Observable
+    from PySPIDER.continuous.process_library_terms import SRDataset
+
+    Nx, Nt = 48, 24
+    x, t = np.arange(Nx) * 4 / Nx, np.arange(Nt) / Nt
+    u = np.stack([4 * np.einsum('i,j,k->ijk', np.sin(4 * x), np.cos(4 * x), np.exp(-0.64 * t)),
+                  -4 * np.einsum('i,j,k->ijk', np.cos(4 * x), np.sin(4 * x), np.exp(-0.64 * t))], axis=3)
+    p = 4 * np.einsum('ij,k->ijk', np.cos(8 * x)[:, None] + np.cos(8 * x)[None, :], np.exp(-1.28 * t))
+    pobs, uobs = Observable(string='p', rank=0), Observable(string='u', rank=1)
+    dataset = SRDataset(world_size=np.array(p.shape), data_dict={'p': p, 'u': u}, observables=[uobs, pobs],
+                        dxs=[4 / Nx, 4 / Nx, 1 / Nt], irreps=(0, 1))
+    dataset.make_libraries(max_complexity=4, max_observable_counts={pobs: 1, uobs: 999}, max_dt=1, max_dx=2)
+    dataset.make_domains(ndomains=4, domain_size=[14, 14, 12])
+    dataset.make_weights(m=6, qmax=1)
+    for irrep in dataset.irreps:
+        for path, nbytes in benchmark_allocations(dataset, irrep).items():
+            print(f'irrep {irrep}, {path} path: {nbytes:.0f} bytes per Q entry')
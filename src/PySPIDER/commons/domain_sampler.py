@@ -0,0 +1,75 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+@dataclass
+class DomainSampler(object): # chooses the corners of integration domains
+    # rng: source of randomness; None = the global np.random state (same draws as the original make_domains)
+    rng: np.random.Generator = None
+    # 'uniform': independent uniform corners; 'stratified': Latin hypercube, i.e. along each dimension, the range of
+    # corners is split into ndomains strata with one domain in each; 'min_overlap': best-candidate (Poisson disk
+    # style) sampling, each domain placed as far as possible from the previous ones
+    strategy: str = 'uniform'
+    n_candidates: int = 30 # candidates tried per domain with 'min_overlap'
+
+    def integers(self, low, high):
+        return int(self.rng.integers(low, high)) if self.rng is not None else np.random.randint(low, high)
+
+    def choice(self, values):
+        return int(self.rng.choice(values)) if self.rng is not None else int(np.random.choice(values))
+
+    def random(self, size):
+        return self.rng.random(size) if self.rng is not None else np.random.random_sample(size)
+
+    def permutation(self, n):
+        return self.rng.permutation(n) if self.rng is not None else np.random.permutation(n)
+
+    def draw(self, allowed): # uniformly random element of a range or list of allowed starts
+        return self.integers(allowed.start, allowed.stop) if isinstance(allowed, range) else self.choice(allowed)
+
+    def sample(self, ndomains, allowed_starts, domain_size): # -> list of ndomains min_corners (lists of ints)
+        # allowed_starts: for each dimension, range or list of allowed values of the corner coordinate
+        # domain_size: extent of the domains along each dimension (used by 'min_overlap')
+        match self.strategy:
+            case 'uniform':
+                return [[self.draw(allowed) for allowed in allowed_starts] for i in range(ndomains)]
+            case 'stratified':
+                columns = []
+                for allowed in allowed_starts:
+                    allowed = list(allowed)
+                    indices = (self.permutation(ndomains) + self.random(ndomains)) * len(allowed) / ndomains
+                    columns.append([allowed[min(int(index), len(allowed) - 1)] for index in indices])
+                return [list(corner) for corner in zip(*columns)]
+            case 'min_overlap':
+                corners = []
+                sizes = np.array(domain_size, dtype=np.float64)
+                for i in range(ndomains):
+                    candidates = np.array([[self.draw(allowed) for allowed in allowed_starts]
+                                           for j in range(self.n_candidates if corners else 1)])
+                    if corners: # Chebyshev distance in units of the domain size; >= 1 means no overlap
+                        distances = np.max(np.abs(candidates[:, None, :] - np.array(corners)[None, :, :]) / sizes,
+                                           axis=2).min(axis=1)
+                        best = candidates[np.argmax(distances)]
+                    else:
+                        best = candidates[0]
+                    corners.append([int(c) for c in best])
+                return corners
+            case _:
+                raise ValueError(f"Unknown domain sampling strategy {self.strategy}")
+
+def overlap_stats(domains): # how much integration domains overlap (overlaps as fractions of a domain's volume)
+    mins = np.array([domain.min_corner for domain in domains])
+    maxs = np.array([domain.max_corner for domain in domains])
+    volumes = np.prod(maxs - mins + 1, axis=1)
+    intersections = np.prod(np.clip(np.minimum(maxs[:, None, :], maxs[None, :, :])
+                                    - np.maximum(mins[:, None, :], mins[None, :, :]) + 1, 0, None), axis=2)
+    fractions = intersections / np.minimum(volumes[:, None], volumes[None, :])
+    pairs = np.triu_indices(len(domains), k=1)
+    pair_fractions = fractions[pairs]
+    np.fill_diagonal(fractions, 0)
+    return {'n_domains': len(domains),
+            'mean_pair_overlap': float(np.mean(pair_fractions)) if len(pair_fractions) else 0.0,
+            'max_pair_overlap': float(np.max(pair_fractions)) if len(pair_fractions) else 0.0,
+            'overlapping_pairs': float(np.mean(pair_fractions > 0)) if len(pair_fractions) else 0.0,
+            # total overlap of each domain with all the others, averaged over domains
+            'mean_domain_overlap': float(np.mean(np.sum(fractions, axis=1)))}
@@ -1,4 +1,7 @@
 # It may or may not be nicer to take the SRDataset object as input for some of these
+import copy
+import os
+from concurrent.futures import ProcessPoolExecutor
 from timeit import default_timer as timer
 from functools import reduce
 from operator import add
@@ -6,6 +9,8 @@ from operator import add
 from PySPIDER.commons.library import *
 from PySPIDER.commons.sparse_reg import *
 from PySPIDER.commons.sparse_reg_bf import *
+from PySPIDER.commons.process_library_terms import domain_rows
+from PySPIDER.commons.shared_arrays import SharedArrayPool, SharedArrayRef
     
 def identify_equations(lib_object, reg_opts, print_opts=None, threshold=1e-5, min_complexity=1,
                        max_complexity=None, max_equations=999, timed=True, experimental=True, report_accuracy=False,
@@ -216,4 +221,104 @@ def form_equation(lhs, rhs):
 def get_primes(library, max_complexity):
     all_primes = set(prime.purge_indices() for term in library 
                      for prime in term.primes if prime.complexity<=max_complexity)
-    return all_primes
\ No newline at end of file
+    return all_primes
+
+class EnsembleResult(object): # distribution of the coefficients of an equation over resampled Q matrices
+    def __init__(self, equation, xi, xis, lambdas, terms, sub_inds):
+        self.equation = equation # equation identified on the full pool of domains
+        self.xi = xi # its coefficient vector (over the full library)
+        self.xis = xis # (n_samples, len(terms)) array: coefficients identified on each sample
+        self.lambdas = lambdas # residual of each sample's model
+        self.terms = terms # full library
+        self.sub_inds = sub_inds # columns of the sublibrary the equation was identified from
+
+    @property
+    def mean(self):
+        return np.mean(self.xis, axis=0)
+
+    @property
+    def std(self):
+        return np.std(self.xis, axis=0)
+
+    @property
+    def inclusion(self): # fraction of samples in which each term has a nonzero coefficient
+        return np.mean(self.xis != 0, axis=0)
+
+    @property
+    def same_support(self): # fraction of samples in which exactly the terms of the equation are selected
+        return np.mean(np.all((self.xis != 0) == (self.xi != 0), axis=1))
+
+    def quantiles(self, q):
+        return np.quantile(self.xis, q, axis=0)
+
+    def summary(self, num_format='{0:.3g}', min_inclusion=0): # one line per term: mean +- std (inclusion fraction)
+        lines = [f'{self.equation.pstr(num_format=num_format)} '
+                 f'(same support in {self.same_support:.0%} of {len(self.xis)} samples)']
+        for i in np.argsort(-self.inclusion, kind='stable'):
+            if self.inclusion[i] > min_inclusion:
+                lines.append(f'  {self.terms[i]}: {num_format.format(self.mean[i])} +- '
+                             f'{num_format.format(self.std[i])} (in {self.inclusion[i]:.0%})')
+        return '\n'.join(lines)
+
+def equation_xi(reg_result, n_terms, threshold): # coefficient vector of the model make_equation_from_Xi selects
+    if reg_result.lambda1 < reg_result.lambd or reg_result.lambda1 < threshold: # one-term model
+        xi = np.zeros(n_terms)
+        xi[reg_result.best_term] = 1
+        return xi
+    return np.array(reg_result.xi, dtype=np.float64)
+
+# globals of bootstrap worker processes (set once per process by init_bootstrap_worker)
+worker_Q = None
+worker_reg_opts = None
+
+def init_bootstrap_worker(Q_init, reg_opts_init):
+    global worker_Q, worker_reg_opts
+    worker_Q = Q_init.attach() if isinstance(Q_init, SharedArrayRef) else Q_init
+    worker_reg_opts = reg_opts_init
+
+def bootstrap_task(sub_inds, rows, threshold): # regression on the rows of Q from one sample of domains
+    reg_opts = dict(worker_reg_opts)
+    reg_opts['scaler'] = copy.copy(reg_opts['scaler'])
+    reg_opts['scaler'].reset_inds(sub_inds)
+    reg_opts['residual'] = copy.copy(reg_opts['residual']) # sparse_reg_bf sets its normalization
+    reg_result = sparse_reg_bf(worker_Q[rows], **reg_opts)
+    xi = equation_xi(reg_result, worker_Q.shape[1], threshold)
+    return xi, min(reg_result.lambd, reg_result.lambda1)
+
+def bootstrap_equations(lib_object, reg_results, reg_opts, domain_samples, n_domains, threshold=1e-5,
+                        parallel=False, num_processors=None):
+    # rerun the regressions that identified a set of equations on resampled Q matrices, without recomputing Q
+    # lib_object: LibraryData whose Q was evaluated on a pool of n_domains domains
+    # reg_results: RegressionResults of the identified equations (e.g. output of identify_equations on lib_object)
+    # reg_opts: options used for the identification
+    # domain_samples: list of arrays of domain indices, e.g. from dataset.draw_domain_samples
+    # threshold: same as in identify_equations; returns a list of EnsembleResults, one per equation
+    library = list(lib_object.terms)
+    Q = lib_object.Q
+    reg_opts = {key: value for key, value in reg_opts.items() if key not in ('term_names', 'verbose')}
+    rows = [domain_rows(Q.shape[0], n_domains, sample) for sample in domain_samples]
+    # the sublibrary of each equation: all terms that were allowed when it was identified
+    all_sub_inds = [[i for i, term in enumerate(library) if term in reg_result.sublibrary]
+                    for reg_result in reg_results]
+    tasks = [(sub_inds, sample_rows, threshold) for sub_inds in all_sub_inds for sample_rows in rows]
+    if parallel:
+        with SharedArrayPool() as pool:
+            with ProcessPoolExecutor(max_workers=num_processors, initializer=init_bootstrap_worker,
+                                     initargs=(pool.share(Q), reg_opts)) as executor:
+                outputs = list(executor.map(bootstrap_task, *zip(*tasks),
+                                            chunksize=max(1, len(tasks) // (4 * (num_processors or os.cpu_count())))))
+    else:
+        init_bootstrap_worker(Q, reg_opts)
+        try:
+            outputs = [bootstrap_task(*task) for task in tasks]
+        finally: # don't keep Q alive in the module globals of the main process
+            init_bootstrap_worker(None, None)
+    results = []
+    for i, (reg_result, sub_inds) in enumerate(zip(reg_results, all_sub_inds)):
+        sample_outputs = outputs[i * len(rows):(i + 1) * len(rows)]
+        equation = make_equation_from_Xi(reg_result, library, threshold)[0]
+        results.append(EnsembleResult(equation=equation, xi=equation_xi(reg_result, len(library), threshold),
+                                      xis=np.array([xi for xi, lambd in sample_outputs]),
+                                      lambdas=np.array([lambd for xi, lambd in sample_outputs]),
+                                      terms=library, sub_inds=sub_inds))
+    return results
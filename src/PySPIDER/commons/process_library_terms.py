@@ -1,16 +1,141 @@
-from typing import Any, Union, Iterable
+from typing import Union, Iterable
 from warnings import warn
 
 import numpy as np
-from findiff import FinDiff
+from findiff import FinDiff, coefficients as findiff_coefficients
+import scipy.ndimage
+from numba import jit, literal_unroll
 from functools import reduce
 from operator import mul
 from dataclasses import dataclass, replace
+from collections import OrderedDict
+import heapq
 
 import concurrent.futures
+import contextlib
+import copy
+import hashlib
+import os
+import pickle
+import time
 
 from PySPIDER.commons.library import *
 from PySPIDER.commons.weight import *
+from PySPIDER.commons.shared_arrays import SharedArrayPool, SharedArrayRef
+from PySPIDER.commons.domain_sampler import DomainSampler, overlap_stats
+
+class FieldCache(object): # storage of evaluated (prime, domain) fields with an optional bound on total memory
+    # eviction is GreedyDual: each entry has priority inflation + cost/size, the lowest priority entry is evicted first
+    # and the inflation is raised to its priority, so cheap, large and long-unused fields go first
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes # None means unbounded
+        self.fields = dict()
+        self.priorities = dict()
+        self.costs = dict()
+        self.heap = [] # (priority, counter, key), may contain stale entries; not kept when unbounded
+        self.counter = 0
+        self.inflation = 0
+        self.pinned = set() # primes whose fields are never evicted
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # dict-style access, so the cache can be used wherever field_dict was a dict
+    def __contains__(self, key):
+        return key in self.fields
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __delitem__(self, key):
+        self.nbytes -= self.fields.pop(key).nbytes
+        del self.priorities[key], self.costs[key]
+
+    def __len__(self):
+        return len(self.fields)
+
+    def keys(self):
+        return self.fields.keys()
+
+    def items(self):
+        return self.fields.items()
+
+    def get(self, key, default=None): # like dict.get, but counts hits and misses
+        if key not in self.fields:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.touch(key)
+        return self.fields[key]
+
+    def touch(self, key):
+        priority = self.inflation + self.costs[key] / max(self.fields[key].nbytes, 1)
+        self.priorities[key] = priority
+        if self.max_bytes is None: # nothing is ever evicted
+            return
+        self.counter += 1
+        heapq.heappush(self.heap, (priority, self.counter, key))
+        if len(self.heap) > 4 * len(self.fields) + 64: # drop stale heap entries every so often
+            self.compact()
+
+    def compact(self): # rebuild the heap from the live entries only
+        self.heap = [(self.priorities[key], i, key) for i, key in enumerate(self.priorities)]
+        heapq.heapify(self.heap)
+        self.counter = len(self.heap)
+
+    def put(self, key, value, cost=1):
+        if key in self.fields:
+            del self[key]
+        if self.max_bytes is not None and value.nbytes > self.max_bytes and key[0] not in self.pinned:
+            return # wouldn't fit anyway
+        self.fields[key] = value
+        self.costs[key] = cost
+        self.nbytes += value.nbytes
+        self.touch(key)
+        self.evict()
+
+    def evict(self):
+        pinned = [] # live entries of pinned primes, put back on the heap so they can be evicted once unpinned
+        while self.max_bytes is not None and self.nbytes > self.max_bytes and self.heap:
+            entry = heapq.heappop(self.heap)
+            priority, _, key = entry
+            if self.priorities.get(key) != priority: # stale heap entry
+                continue
+            if key[0] in self.pinned:
+                pinned.append(entry)
+                continue
+            self.inflation = priority
+            del self[key]
+            self.evictions += 1
+        for entry in pinned:
+            heapq.heappush(self.heap, entry)
+
+    def pin(self, prime): # keep fields of this prime on every domain
+        self.pinned.add(prime)
+
+    def unpin(self, prime):
+        self.pinned.discard(prime)
+        self.evict()
+
+    def clear(self):
+        self.fields.clear()
+        self.priorities.clear()
+        self.costs.clear()
+        self.heap = []
+        self.counter = 0
+        self.inflation = 0
+        self.nbytes = 0
+
+    def stats(self):
+        return {'entries': len(self.fields), 'bytes': self.nbytes, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+    def __repr__(self):
+        return f"FieldCache({self.stats()}, max_bytes={self.max_bytes})"
 
 # if we want to use integration domains with different sizes & spacings, it might be
 # better to store that information within this object as well
@@ -41,6 +166,53 @@ class IntegrationDomain(object):
             return NotImplemented
         return self.min_corner == other.min_corner and self.max_corner == self.max_corner
 
+class WeightArrayCache(object): # LRU cache of unscaled weight evaluations with a bound on total memory
+    def __init__(self, max_bytes=2**28):
+        self.max_bytes = max_bytes # None means unbounded
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def size_of(value): # arrays or lists of arrays
+        return value.nbytes if isinstance(value, np.ndarray) else sum(arr.nbytes for arr in value)
+
+    def get(self, key, make_value):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        value = make_value()
+        size = self.size_of(value)
+        if self.max_bytes is not None and size > self.max_bytes: # wouldn't fit anyway
+            return value
+        for arr in ([value] if isinstance(value, np.ndarray) else value):
+            arr.flags.writeable = False # entries are shared between callers
+        self.entries[key] = value
+        self.nbytes += size
+        while self.max_bytes is not None and self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= self.size_of(evicted)
+        return value
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        while self.max_bytes is not None and self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= self.size_of(evicted)
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+# per-process cache, so each ProcessPoolExecutor worker gets its own copy
+weight_cache = WeightArrayCache()
+
+def set_weight_cache_size(max_bytes): # byte budget of the weight cache in this process (None = unbounded)
+    weight_cache.resize(max_bytes)
+
 @dataclass
 class Weight(object): # scalar-valued Legendre polynomial weight function (may rename class to LegendreWeight)
     m: List[int]
@@ -63,13 +235,41 @@ class Weight(object): # scalar-valued Legendre polynomial weight function (may r
         self.ready = True
         self.weight_objs = [weight_1d(m, q, k, dx) for (m, q, k, dx) in zip(self.m, self.q, self.k, self.dxs)]
 
-    def get_weight_array(self, dims):
+    def cache_key(self, dims): # everything that determines the unscaled weight on a grid of shape dims
+        return (tuple(int(m) for m in self.m), tuple(int(q) for q in self.q), tuple(int(k) for k in self.k),
+                tuple(float(dx) for dx in self.dxs), tuple(int(dim) for dim in dims))
+
+    def eval_1d(self, dims): # unscaled 1D factors of the weight along each dimension
         if not self.ready:
             self.make_weight_objs()
-        weights_eval = [weight.linspace(dim)[1] for (weight, dim) in zip(self.weight_objs, dims)]
+        return [weight.linspace(dim)[1] for (weight, dim) in zip(self.weight_objs, dims)]
+
+    def get_weight_array(self, dims):
         if self.scale == 0: # short-circuit the zero weight case
             return np.zeros(dims)
-        return self.scale * reduce(lambda x, y: np.tensordot(x, y, axes=0), weights_eval)
+        unscaled = weight_cache.get(('array', *self.cache_key(dims)),
+                                    lambda: reduce(lambda x, y: np.tensordot(x, y, axes=0), self.eval_1d(dims)))
+        return self.scale * unscaled
+
+    def get_weight_vectors(self, dims): # 1D factors of the weight along each dimension (scale folded into the first)
+        weights_eval = list(weight_cache.get(('vectors', *self.cache_key(dims)), lambda: self.eval_1d(dims)))
+        weights_eval[0] = self.scale * weights_eval[0]
+        return weights_eval
+
+    def integrate(self, arr): # same as int_arr(arr * self.get_weight_array(arr.shape)), one axis at a time
+        result = arr
+        for vector in self.get_weight_vectors(arr.shape):
+            # contracting axis 0 each time walks through the dimensions in order
+            result = np.tensordot(vector * trapezoid_weights_1d(len(vector)), result, axes=(0, 0))
+        return result
+
+    def integrate_product(self, arrays, dims): # same as integrate(product of arrays), without forming the product
+        # arrays: fields of shape dims (no arrays = integrate the weight itself)
+        if self.scale == 0:
+            return 0
+        vectors = weight_cache.get(('quadrature', *self.cache_key(dims)),
+                                   lambda: [vector * trapezoid_weights_1d(len(vector)) for vector in self.eval_1d(dims)])
+        return self.scale * fused_integral(arrays, vectors)
 
     def increment(self, dim):  # return new weight with an extra derivative on the dim-th dimension
         knew = self.k.copy()
@@ -316,34 +516,81 @@ class LibraryData(object):  # structures information associated with a given ran
     Q: np.ndarray = None
     col_weights: Iterable[float] = None
     row_weights: Iterable[float] = None
+    # reprs of the terms, base weights and domains (and by_parts) that Q was computed for - used for incremental updates
+    Q_keys: Tuple[List[str], List[str], List[str], bool] = None
 
     def clear_results(self): # create a copy of self without results computed
-        return replace(self, Q=None, col_weights=None, row_weights=None)
+        return replace(self, Q=None, col_weights=None, row_weights=None, Q_keys=None)
 
-#function for initializing global variables for each parallel worker process
-def init_domain_worker(dataset_init, current_irrep_init, by_parts_init, debug_init):
-    global worker_dataset, worker_current_irrep, worker_by_parts, worker_debug
-    worker_dataset = dataset_init
-    worker_current_irrep = current_irrep_init
-    worker_by_parts = by_parts_init
-    worker_debug = debug_init
+@dataclass
+class EvaluationPlan(object): # symbolic expansion of a library, reusable for any set of domains
+    irrep: Irrep
+    terms: List[LibraryTerm]
+    row_weights: List[int] # index (into dataset.weights) of the base weight of each tensor weight row
+    # per column: list of (indexed primes, weight k-vector, coefficient, tensor weight row) after index assignment and
+    # integration by parts; the weight of an entry is coefficient * (base weight of the row with derivatives k)
+    entries: List[List[Tuple[Tuple[LibraryPrime, ...], Tuple[int, ...], float, int]]]
+    key: str = None
 
-#function to be executed in parallel to evaluate all terms for a given domain
-def parallel_domain_task(domain):
-    dataset = worker_dataset
-    irrep = worker_current_irrep
-    by_parts = worker_by_parts
-    debug = worker_debug
+    @property
+    def n_rows(self): # number of rows per domain
+        return len(self.row_weights)
 
-    domain_results_dict = defaultdict(float)
+    def make_weights(self, weights): # Weight objects of every entry given the dataset's base weights
+        return [[replace(weights[self.row_weights[row]], k=list(k), scale=coeff, ready=False)
+                 for (primes, k, coeff, row) in column] for column in self.entries]
 
-    for t, w, term, tensor_weight in dataset.integrated_terms_tuples:
-        if w.scale == 0:
-            continue
-        value = dataset.eval_on_domain(t,w,domain,debug=debug)
-        key = term, tensor_weight
-        domain_results_dict[key] += value
-    return domain, domain_results_dict
+    def primes(self, cols=None): # distinct primes needed to evaluate (a subset of) the columns
+        cols = range(len(self.entries)) if cols is None else cols
+        return {prime for col in cols for (primes, k, coeff, row) in self.entries[col] for prime in primes}
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+#function for initializing global variables for each parallel worker process
+def init_domain_worker(dataset_init, plans_init, debug_init, weight_cache_bytes_init=None):
+    # plans_init: dict irrep -> EvaluationPlan of every irrep the pool will work on
+    global worker_dataset, worker_plans, worker_plan_weights, worker_debug
+    worker_dataset = dataset_init
+    worker_dataset.attach_shared_arrays() # no-op unless the dataset was sent as a shared descriptor
+    worker_plans = plans_init
+    worker_plan_weights = {irrep: plan.make_weights(dataset_init.weights) for irrep, plan in plans_init.items()}
+    worker_debug = debug_init
+    set_weight_cache_size(weight_cache_bytes_init)
+
+#function to be executed in parallel to evaluate a tile of (domains x columns) of the plan
+def parallel_tile_task(irrep, domain_indices, cols):
+    start = time.perf_counter()
+    plan, plan_weights = worker_plans[irrep], worker_plan_weights[irrep]
+    blocks = np.stack([worker_dataset.eval_plan_on_domain(plan, plan_weights, worker_dataset.domains[d],
+                                                          cols=cols, debug=worker_debug) for d in domain_indices])
+    timing = {'irrep': irrep, 'domains': domain_indices, 'cols': cols, 'seconds': time.perf_counter()-start,
+              'worker': os.getpid()}
+    return domain_indices, cols, blocks, timing
+
+#function to be executed in parallel to evaluate every plan on a group of domains, sharing primes between irreps
+def parallel_all_irreps_task(domain_indices, cols=None): # cols: irrep -> columns to evaluate (None/missing = all)
+    start = time.perf_counter()
+    cols = dict() if cols is None else cols
+    all_primes = set().union(*(plan.primes(cols.get(irrep)) for irrep, plan in worker_plans.items()))
+    blocks = {irrep: [] for irrep in worker_plans}
+    for d in domain_indices:
+        domain = worker_dataset.domains[d]
+        fields = worker_dataset.eval_fields(all_primes, domain)
+        for irrep, plan in worker_plans.items():
+            blocks[irrep].append(worker_dataset.eval_plan_on_domain(plan, worker_plan_weights[irrep], domain,
+                                                                    cols=cols.get(irrep), debug=worker_debug,
+                                                                    fields=fields))
+        del fields
+        worker_dataset.release_domain(domain)
+    timing = {'domains': domain_indices, 'seconds': time.perf_counter()-start, 'worker': os.getpid()}
+    return domain_indices, {irrep: np.stack(irrep_blocks) for irrep, irrep_blocks in blocks.items()}, timing
 
 @dataclass(kw_only=True)
 class AbstractDataset(object): # template for structure of all data associated with a given sparse regression dataset
@@ -352,7 +599,8 @@ class AbstractDataset(object): # template for structure of all data associated w
     observables: List[Observable]  # list of observables
     # storage of computed quantities: (prim, domains) [not dims] -> array
     cache_primes: bool = True # whether the field_dict is used
-    field_dict: dict[tuple[Any, ...], np.ndarray[float]] = None 
+    field_dict: FieldCache = None 
+    field_cache_bytes: int = None # memory limit of field_dict (None = unbounded)
     
     dxs: List[float] = None # grid spacings
     weight_dxs: List[float] = None
@@ -361,6 +609,7 @@ class AbstractDataset(object): # template for structure of all data associated w
     # size of domain in grid units (NOT SUBGRID UNITS, AS ACTUALLY USED IN DISCRETE COMPUTATION)
     domain_size: List[float] = None 
     domains: List[IntegrationDomain] = None
+    domain_sampler: DomainSampler = None # how make_domains chooses domains (None = uniformly, with np.random)
     pad: float = 0
     libs: Dict[Union[int, Irrep], LibraryData] = None # irrep label (e.g. 0, 1, "2s" irrep) -> LibraryData object
     irreps: List[Union[int, str]] = (0, 1) # set of irreducible representations to generate libraries for = libs.keys()
@@ -371,22 +620,37 @@ class AbstractDataset(object): # template for structure of all data associated w
 
     metric: Metric = None # we support only constant coeff metrics for now
     metric_is_identity: bool = True
+    separable_weights: bool = True # integrate against weights axis by axis instead of forming weight arrays
+    fused_kernel: bool = True # with separable_weights, integrate weight * product of primes in one pass (fused_integral)
+    batch_bytes: int = 2**27 # memory budget of the stack of domains in make_Q_batched (sets the default batch_size)
 
-    integrated_terms_tuples: List[Tuple[LibraryTerm,Weight,LibraryTerm,TensorWeight]] = None
+    plans: Dict[str, EvaluationPlan] = field(default_factory=dict) # plan key -> EvaluationPlan (shared by resamples)
+    plan_cache_dir: str = None # directory for storing EvaluationPlans on disk (None = memory only)
+    task_timings: Dict[Union[int, Irrep], List[dict]] = field(default_factory=dict) # per-task timings of make_Q_parallel
+    result_cache_dir: str = None # directory for storing evaluated fields and Q matrices on disk (None = disabled)
+    disk_cache_fields: bool = True # whether evaluated (prime, domain) fields are also stored in result_cache_dir
+
+    # large array attributes (besides data_dict) that parallel workers can attach to instead of unpickling
+    shared_array_attributes = ()
 
     def __post_init__(self):
         self.n_dimensions = len(self.world_size) # number of dimensions (spatial + temporal)
         # consider n_spatial_dim field
-        self.field_dict = dict()
+        self.field_dict = FieldCache(max_bytes=self.field_cache_bytes)
+        self.data_hash_value = None # memoized result of data_hash
         if self.metric is None: 
             self.metric = Metric(n_dimensions=self.n_dimensions)
         else:
             self.metric_is_identity = False
 
-    def resample(self): # should return SRD that is instance of implementing classes, so this is not type-hinted
-        new_srd = replace(self, domains=None, libs={irrep: lib.clear_results() for irrep, lib in self.libs.items()})
+    def resample(self, sampler=None): # should return SRD that is instance of implementing classes, so this is not type-hinted
+        # sampler: DomainSampler to draw the new domains with (default: domain_sampler)
+        # (an identity metric is rebuilt by __post_init__, otherwise it would be flagged as non-identity)
+        new_srd = replace(self, domains=None, libs={irrep: lib.clear_results() for irrep, lib in self.libs.items()},
+                          metric=None if self.metric_is_identity else self.metric)
+        new_srd.weights = self.weights # not a dataclass field, so replace doesn't carry it over
         # remake domains
-        new_srd.make_domains(ndomains=len(self.domains), domain_size=self.domain_size, pad=self.pad)
+        new_srd.make_domains(ndomains=len(self.domains), domain_size=self.domain_size, pad=self.pad, sampler=sampler)
         # recompute Q etc.
         new_srd.make_library_matrices(debug=False)
         return new_srd
@@ -402,9 +666,17 @@ class AbstractDataset(object): # template for structure of all data associated w
     def make_libraries(self, **kwargs): # populate libs
         pass
 
-    def make_domains(self, ndomains, domain_size, pad=0): # set domain_size/populate domains
+    def make_domains(self, ndomains, domain_size, pad=0, sampler=None): # set domain_size/populate domains
         pass
 
+    def get_domain_sampler(self, sampler=None): # sampler to use in make_domains
+        if sampler is not None:
+            return sampler
+        return self.domain_sampler if self.domain_sampler is not None else DomainSampler()
+
+    def domain_overlap_stats(self): # statistics of the overlaps between domains (see overlap_stats)
+        return overlap_stats(self.domains)
+
     def make_weights(self, m, qmax): # populate weights/set weight_dxs
         self.weights = []
         self.weight_dxs = [(width - 1) / 2 * dx for width, dx in zip(self.domain_size, self.dxs)]
@@ -431,9 +703,17 @@ class AbstractDataset(object): # template for structure of all data associated w
         else:
             raise NotImplemented
     
-    def eval_on_domain(self, term, weight, domain, debug=False):
+    def eval_on_domain(self, term, weight, domain, debug=False, fields=None, fused=None, separable=None):
+        # fused: whether to use fused_integral with separable_weights (None = fused_kernel)
+        # separable: whether to integrate against the separable weight factors (None = separable_weights)
+        fused = self.fused_kernel if fused is None else fused
+        separable = self.separable_weights if separable is None else separable
+        if separable and not debug: # never materialize the full weight array
+            if fused: # ...or the product of the primes
+                return weight.integrate_product(self.term_fields(term, domain, fields), domain.shape)
+            return weight.integrate(self.eval_term(term, domain, debug, fields))
         #print('weight_array hash', hash(weight.get_weight_array(domain.shape).tostring()))
-        term_weight_product = self.eval_term(term, domain, debug) * weight.get_weight_array(domain.shape)
+        term_weight_product = self.eval_term(term, domain, debug, fields) * weight.get_weight_array(domain.shape)
         if debug:
             filtered_flat = list(filter(lambda x: x!=0, term_weight_product.flat))
             lenf = len(filtered_flat)
@@ -453,29 +733,72 @@ class AbstractDataset(object): # template for structure of all data associated w
             product *= self.metric[ind1, ind2] 
         return product
     
-    def eval_term(self, term, domain, debug=False): # evaluate a term on domain
+    def eval_term(self, term, domain, debug=False, fields=None): # evaluate a term on domain
         # term: LibraryTerm
         # domain: IntegrationDomain corresponding to where the term is evaluated
+        # fields: optional dict of already evaluated primes on this domain (bypasses field_dict)
         # return the evaluated term on the domain grid
         product = np.ones(shape=domain.shape)
-        if isinstance(term, ConstantTerm): # short-circuit
-            return product
-        #if debug:
-        #    print(f"LibraryTerm {term}")
-        for prime in term.primes:
-        #    if debug:
-        #        print(f"LibraryPrime {prime}")
-            if self.cache_primes and (prime, domain) in self.field_dict.keys():  # field is "cached"
-                data_slice = self.field_dict[prime, domain]
-            else:
-                data_slice = self.eval_prime(prime, domain)
-                if self.cache_primes:
-                    self.field_dict[prime, domain] = data_slice
-            #print(product.shape, data_slice.shape)
+        for data_slice in self.term_fields(term, domain, fields):
             product *= data_slice
-            # print(product[0, 0, 0])
         return product
 
+    def term_fields(self, term, domain, fields=None): # list of the evaluated primes of a term on domain
+        if isinstance(term, ConstantTerm): # short-circuit
+            return []
+        # terms may also be given as tuples of primes
+        return [fields[prime] if fields is not None else self.get_field(prime, domain)
+                for prime in (term if isinstance(term, tuple) else term.primes)]
+
+    def get_field(self, prime, domain): # evaluate prime on domain, going through field_dict if cache_primes is set
+        if not self.cache_primes:
+            return self.compute_field(prime, domain)
+        data_slice = self.field_dict.get((prime, domain))
+        if data_slice is None:
+            data_slice = self.compute_field(prime, domain)
+            self.field_dict.put((prime, domain), data_slice, cost=self.prime_cost(prime))
+        return data_slice
+
+    def compute_field(self, prime, domain): # eval_prime, going through the on-disk field cache if it is enabled
+        if self.result_cache_dir is None or not self.disk_cache_fields:
+            return self.eval_prime(prime, domain)
+        filename = self.field_filename(prime, domain)
+        if os.path.exists(filename):
+            return np.load(filename)
+        data_slice = self.eval_prime(prime, domain)
+        save_atomic(filename, data_slice)
+        return data_slice
+
+    def prime_cost(self, prime): # relative cost of recomputing a prime (used for cache eviction)
+        return 1 + prime.nderivs
+
+    def eval_settings(self): # settings (besides the data) that determine the values of evaluated primes
+        return {'dxs': None if self.dxs is None else [float(dx) for dx in self.dxs]}
+
+    def data_hash(self): # content hash of the data arrays and eval_settings
+        # (the hash of the arrays is memoized - don't modify data in place!)
+        if self.data_hash_value is None:
+            h = hashlib.sha1()
+            arrays = [(repr(name), arr) for name, arr in self.data_dict.items()]
+            arrays += [(attr, getattr(self, attr)) for attr in self.shared_array_attributes]
+            for name, arr in sorted(arrays, key=lambda item: item[0]):
+                h.update(name.encode())
+                if isinstance(arr, np.ndarray):
+                    arr = np.ascontiguousarray(arr)
+                    h.update(repr((arr.dtype.str, arr.shape)).encode())
+                    h.update(arr.data)
+                elif hasattr(arr, 'content_key'): # e.g. StreamingSource: file location, size and mtime
+                    h.update(repr(arr.content_key()).encode())
+                else:
+                    h.update(repr(arr).encode())
+            self.data_hash_value = h.hexdigest()
+        # settings may depend on the domains etc., so they are not memoized
+        return hashlib.sha1((self.data_hash_value + repr(self.eval_settings())).encode()).hexdigest()
+
+    def field_filename(self, prime, domain): # location of an evaluated field in result_cache_dir
+        key = hashlib.sha1(repr((prime, domain)).encode()).hexdigest()
+        return os.path.join(self.result_cache_dir, f"fields_{self.data_hash()}", f"{key}.npy")
+
     # evaluate prime on a domain - DIFFERENT IMPLEMENTATIONS for continuous and discrete!
     def eval_prime(self, prime, domain, *args): 
         pass
@@ -493,117 +816,419 @@ class AbstractDataset(object): # template for structure of all data associated w
     #     else:
     #         return np.einsum('ij..., jk, ik->...', product_values, self.metric, tensor_weight, optimize=True)
 
-    def make_Q(self, irrep, by_parts=True, debug=False): # compute Q matrix for given irrep
-        #debug = True
-        #by_parts = False
-        cols_list = []
-        for term in self.libs[irrep].terms:
+    def get_integrated_terms(self, irrep, by_parts=True, debug=False): # symbolic part of make_Q: (t, w, term, tensor_weight) tuples
+        integrated_terms_tuples = []
+        for term in list(self.libs[irrep].terms):
             if debug:
                 print("UNINDEXED TERM:")
                 print(term)
-            column = []
-            if debug:
-                term_symmetry = term.symmetry()
-                print("Symmetry:", term_symmetry)
-            wd_dict = defaultdict(int) # group by weight/domain, aggregate by assignment & integration by parts term
-            for weight in self.weights:
-                for tensor_weight in self.tensor_weight_basis[irrep, weight].tw_list:
+                print("Symmetry:", term.symmetry())
+            for weight in list(self.weights):
+                for tensor_weight in self.tensor_weight_basis[(irrep, weight)].tw_list:
                     if debug:
                         print("Tensor weight:", tensor_weight)
-                    # compute weight(term) on each domain: w(t)|d = sum_(wi'(ti'))|d
                     for indexed_term, scalar_weight in self.get_index_assignments(term, tensor_weight, debug):
-                        if debug:
-                            print("ASSIGNMENTS:", term, "->")
-                            print("Indexed term:", indexed_term)
-                            print("Scalar weight:", scalar_weight)
                         for t, w in int_by_parts(indexed_term, scalar_weight, by_parts):
-                            if w.scale == 0:
-                                continue
                             if debug:
-                                print("INT BY PARTS:", indexed_term, "->")
-                                print("Integrated term:", t)
-                                print("Integrated weight:", w)
-                            for domain in self.domains:
-                                #if debug:
-                                #    print("Domain:", domain)
-                                debug_this_value = (domain==self.domains[0] and weight==self.weights[0] and debug)
-                                wd_dict[tensor_weight, domain] += self.eval_on_domain(t, w, domain, debug=debug_this_value)
-                                if debug_this_value:
-                                    print('I_TERM', t, 'I_WEIGHT', w, 'CURR RESULT', wd_dict[tensor_weight, domain])
-
-                    # # fair question: should we integrate and then multiply by the tensor or multiply and then integrate?
-                    # for domain in domains:
-                    #     arr = self.shortcut_trace(pv_dict[tensor_weight, domain], tensor_weight.tensor)
-                    #     column.append(int_arr(arr, self.dxs)) # integrate the product array
-            for weight in self.weights:
-                for tensor_weight in self.tensor_weight_basis[irrep, weight].tw_list:
-                    for domain in self.domains:
-                        column.append(wd_dict[tensor_weight, domain])
-            cols_list.append(column)
-        return np.array(cols_list).transpose() # convert to numpy array
-    
-    def make_Q_parallel(self, irrep, by_parts=True, debug=False, num_processors=None):
-        
-        init_args = (self, irrep, by_parts, debug)
-        domains = self.domains
-        all_results = []
+                                print("INT BY PARTS:", indexed_term, "->", t, "with weight", w)
+                            integrated_terms_tuples.append((t,w,term,tensor_weight))
+        return integrated_terms_tuples
 
-        #precompute symbolic manipulations for parallel tasks
-        self.integrated_terms_tuples = []
-        for term in list(self.libs[irrep].terms):
-            for weight in list(self.weights):
-                for tensor_weight in self.tensor_weight_basis[(irrep, weight)].tw_list:
-                    for indexed_term, scalar_weight in self.get_index_assignments(term,tensor_weight):
-                        for t, w in int_by_parts(indexed_term, scalar_weight, by_parts):
-                            self.integrated_terms_tuples.append((t,w,term,tensor_weight))
-
-        #begin parallel task execution
-        with concurrent.futures.ProcessPoolExecutor(max_workers=num_processors, initializer=init_domain_worker, initargs=init_args) as executor:
-            results = executor.map(parallel_domain_task, domains)
-            for result in results:
-                all_results.append(result)
-                  
+    def plan_key(self, irrep, by_parts=True): # hash of everything the symbolic expansion depends on
+        description = repr((irrep, [repr(term) for term in self.libs[irrep].terms],
+                            [(list(weight.m), list(weight.q)) for weight in self.weights],
+                            self.n_dimensions, by_parts, self.metric_is_identity))
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def make_plan(self, irrep, by_parts=True, debug=False): # build EvaluationPlan from scratch
         terms = list(self.libs[irrep].terms)
-        weights = list(self.weights)
-        num_cols = len(terms)
+        row_tws, row_weights = [], []
+        for i, weight in enumerate(self.weights):
+            for tensor_weight in self.tensor_weight_basis[irrep, weight].tw_list:
+                row_tws.append(tensor_weight)
+                row_weights.append(i)
         term_to_col_idx = {term: i for i, term in enumerate(terms)}
-        row_map = {}
-        current_row_idx = 0
-        for weight in weights:
-            for tensor_weight in self.tensor_weight_basis[(irrep, weight)].tw_list:
-                for domain in domains:
-                    row_key = (tensor_weight, domain)
-                    if row_key not in row_map:
-                        row_map[row_key] = current_row_idx
-                        current_row_idx += 1
-        num_rows = current_row_idx
-
-        Q_matrix = np.zeros((num_rows, num_cols), dtype=np.float64)
-
-        for domain, domain_results in all_results:
-            for (term, tensor_weight), result in domain_results.items():
-                col_idx = term_to_col_idx[term]
-                row_idx = row_map[(tensor_weight, domain)]
-
-                Q_matrix[row_idx, col_idx] = result
+        tw_to_row_idx = {tensor_weight: i for i, tensor_weight in enumerate(row_tws)}
+        entries = [[] for term in terms]
+        for t, w, term, tensor_weight in self.get_integrated_terms(irrep, by_parts, debug):
+            if w.scale == 0:
+                continue
+            primes = () if isinstance(t, ConstantTerm) else tuple(t.primes)
+            entries[term_to_col_idx[term]].append((primes, tuple(w.k), w.scale, tw_to_row_idx[tensor_weight]))
+        return EvaluationPlan(irrep=irrep, terms=terms, row_weights=row_weights, entries=entries,
+                              key=self.plan_key(irrep, by_parts))
+
+    def get_plan(self, irrep, by_parts=True, debug=False): # look up EvaluationPlan in memory, then on disk, then build it
+        key = self.plan_key(irrep, by_parts)
+        if key in self.plans:
+            return self.plans[key]
+        filename = os.path.join(self.plan_cache_dir, f"plan_{key}.pkl") if self.plan_cache_dir is not None else None
+        if filename is not None and os.path.exists(filename):
+            plan = EvaluationPlan.load(filename)
+        else:
+            plan = self.make_plan(irrep, by_parts, debug)
+            if filename is not None:
+                os.makedirs(self.plan_cache_dir, exist_ok=True)
+                plan.save(filename)
+        self.plans[key] = plan
+        return plan
+
+    def Q_key(self, irrep, by_parts=True): # hash of everything the columns of a Q matrix depend on besides their term
+        description = repr((self.data_hash(), irrep, [repr(weight) for weight in self.weights], self.domains,
+                            self.n_dimensions, by_parts, self.metric_is_identity, repr(self.metric)))
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def Q_filename(self, irrep, by_parts=True):
+        return os.path.join(self.result_cache_dir, f"Q_{self.Q_key(irrep, by_parts)}.npz")
+
+    def cached_columns(self, irrep, by_parts=True): # term repr -> column of Q stored in result_cache_dir
+        filename = self.Q_filename(irrep, by_parts)
+        if not os.path.exists(filename):
+            return dict()
+        with np.load(filename) as npz:
+            return dict(zip(npz['terms'], npz['Q'].T))
+
+    def make_Q_cached(self, irrep, by_parts=True, debug=False, compute_Q=None): # compute Q using result_cache_dir
+        # columns of terms found on disk are loaded, only the remaining ones are evaluated, and the file is updated
+        # compute_Q(cols): columns cols of Q (None = all of them, i.e. no column is cached; default: make_Q, or
+        # make_Q_columns for some columns)
+        terms = [repr(term) for term in self.libs[irrep].terms]
+        cached = self.cached_columns(irrep, by_parts)
+        missing = self.missing_columns(irrep, by_parts, cached)
+        if debug:
+            print(f"{len(terms)-len(missing)} of {len(terms)} columns found in cache")
+        if compute_Q is None:
+            compute_Q = lambda cols: self.make_Q(irrep, by_parts, debug) if cols is None else \
+                self.make_Q_columns(irrep, cols, by_parts, debug)
+        if len(missing) == len(terms):
+            Q_matrix = compute_Q(None)
+        else:
+            Q_matrix = np.zeros((len(next(iter(cached.values()))), len(terms)), dtype=np.float64)
+            for j, term in enumerate(terms):
+                if term in cached:
+                    Q_matrix[:, j] = cached[term]
+            if missing:
+                Q_matrix[:, missing] = compute_Q(missing)
+        if missing: # keep columns of terms that are no longer in the library too
+            cached.update(zip(terms, Q_matrix.T))
+            save_atomic(self.Q_filename(irrep, by_parts), terms=np.array(list(cached.keys())),
+                        Q=np.stack(list(cached.values()), axis=1))
+        return Q_matrix
 
+    def missing_columns(self, irrep, by_parts=True, cached=None): # columns of Q not found in result_cache_dir
+        cached = self.cached_columns(irrep, by_parts) if cached is None else cached
+        return [j for j, term in enumerate(self.libs[irrep].terms) if repr(term) not in cached]
+
+    def make_Q_columns(self, irrep, cols, by_parts=True, debug=False): # columns cols of the Q matrix of irrep
+        plan = self.get_plan(irrep, by_parts, debug)
+        plan_weights = plan.make_weights(self.weights)
+        n_domains = len(self.domains)
+        Q = np.zeros((plan.n_rows * n_domains, len(cols)))
+        for d, domain in enumerate(self.domains):
+            Q[d::n_domains, :] = self.eval_plan_on_domain(plan, plan_weights, domain, cols=cols, debug=debug)
+        return Q
+
+    def eval_plan_on_domain(self, plan, plan_weights, domain, cols=None, debug=False, fields=None,
+                            weight_indices=None):
+        # evaluate (a subset of) the columns of a plan on one domain -> array of shape (plan.n_rows, len(cols))
+        # weight_indices: only evaluate the rows of these base weights (the other rows are left at zero)
+        cols = range(len(plan.entries)) if cols is None else cols
+        block = np.zeros((plan.n_rows, len(cols)))
+        for j, col in enumerate(cols):
+            for (primes, k, coeff, row), weight in zip(plan.entries[col], plan_weights[col]):
+                if weight_indices is None or plan.row_weights[row] in weight_indices:
+                    block[row, j] += self.eval_on_domain(primes, weight, domain, debug=debug, fields=fields)
+        return block
+
+    def make_Q(self, irrep, by_parts=True, debug=False): # compute Q matrix for given irrep
+        plan = self.get_plan(irrep, by_parts, debug)
+        plan_weights = plan.make_weights(self.weights)
+        n_domains = len(self.domains)
+        Q = np.zeros((plan.n_rows * n_domains, len(plan.terms)))
+        # rows are grouped by weight, then tensor weight, then domain
+        for col, column in enumerate(plan.entries):
+            for (primes, k, coeff, row), weight in zip(column, plan_weights[col]):
+                for d, domain in enumerate(self.domains):
+                    debug_this_value = (d==0 and plan.row_weights[row]==0 and debug)
+                    Q[row * n_domains + d, col] += self.eval_on_domain(primes, weight, domain, debug=debug_this_value)
+                    if debug_this_value:
+                        print('I_TERM', primes, 'I_WEIGHT', weight, 'CURR RESULT', Q[row * n_domains + d, col])
+        return Q
+
+    def make_Q_batched(self, irrep, by_parts=True, debug=False, batch_size=None): # compute Q matrix for given irrep
+        # same result as make_Q, but each integrated term is evaluated on a stack of domains and contracted against
+        # a stack of weights (with the trapezoid quadrature folded in) in a single tensordot
+        # batch_size: domains per stack (None = as many as fit in batch_bytes)
+        shape = tuple(self.domains[0].shape)
+        assert all(tuple(domain.shape) == shape for domain in self.domains), \
+            "Batched evaluation requires all domains to have the same shape"
+        n_domains = len(self.domains)
+        if batch_size is None:
+            batch_size = max(1, min(n_domains, self.batch_bytes // (8 * int(np.prod(shape)))))
+        quadrature = trapezoid_weights(shape)
+        axes = tuple(range(1, len(shape)+1))
+        plan = self.get_plan(irrep, by_parts, debug)
+        plan_weights = plan.make_weights(self.weights)
+        cols_list = []
+        for col, column in enumerate(plan.entries):
+            # group by integrated term: primes -> [(row, weight)], whose weight stack of shape (n_rows, *domain.shape)
+            # is only formed while that term is being integrated
+            term_weights = dict()
+            for (primes, k, coeff, row), weight in zip(column, plan_weights[col]):
+                term_weights.setdefault(primes, []).append((row, weight))
+            column = np.zeros((plan.n_rows, n_domains))
+            for primes, row_weights in term_weights.items():
+                weight_stack = np.zeros((plan.n_rows, *shape))
+                for row, weight in row_weights:
+                    weight_stack[row] += weight.get_weight_array(shape)
+                weight_stack *= quadrature
+                for start in range(0, n_domains, batch_size):
+                    batch = self.domains[start:start+batch_size]
+                    term_stack = np.stack([self.eval_term(primes, domain) for domain in batch]) # (n_batch, *shape)
+                    column[:, start:start+len(batch)] += np.tensordot(weight_stack, term_stack, axes=(axes, axes))
+            cols_list.append(column.ravel())
+        return np.array(cols_list).transpose()
+
+    def make_Q_domain_major(self, irrep, by_parts=True, debug=False): # compute Q matrix for given irrep
+        # same result as make_Q, but the outer loop is over domains: every prime the (integrated) library needs is
+        # evaluated once on the current domain, all of its rows are filled, and the fields are dropped again
+        plan = self.get_plan(irrep, by_parts, debug)
+        plan_weights = plan.make_weights(self.weights)
+        primes = plan.primes()
+        if debug:
+            print(f"{sum(len(column) for column in plan.entries)} integrated terms using {len(primes)} distinct primes")
+
+        n_domains = len(self.domains)
+        Q = np.zeros((plan.n_rows * n_domains, len(plan.terms)))
+        for d, domain in enumerate(self.domains):
+            fields = self.eval_fields(primes, domain)
+            Q[d::n_domains, :] = self.eval_plan_on_domain(plan, plan_weights, domain, fields=fields)
+            del fields
+            self.release_domain(domain)
+        return Q
+
+    def eval_fields(self, primes, domain): # evaluate a set of primes on a domain without filling up field_dict
+        fields = dict()
+        for prime in primes:
+            data_slice = self.field_dict.get((prime, domain)) if self.cache_primes else None
+            if data_slice is None:
+                data_slice = self.compute_field(prime, domain)
+                if self.cache_primes and prime in self.field_dict.pinned:
+                    self.field_dict.put((prime, domain), data_slice, cost=self.prime_cost(prime))
+            fields[prime] = data_slice
+        return fields
+
+    def release_domain(self, domain): # free intermediate results kept for evaluating primes on domain
+        pass
+
+    def make_shared_descriptor(self, pool): # slim copy of self whose large arrays are handles into pool
+        descriptor = copy.copy(self)
+        descriptor.data_dict = {name: pool.share(arr) if isinstance(arr, np.ndarray) else arr
+                                for name, arr in self.data_dict.items()}
+        for attr in self.shared_array_attributes:
+            setattr(descriptor, attr, pool.share(getattr(self, attr)))
+        descriptor.field_dict = FieldCache(max_bytes=self.field_cache_bytes) # don't ship cached fields
+        descriptor.field_dict.pinned = set(self.field_dict.pinned)
+        return descriptor
+
+    def attach_shared_arrays(self): # replace shared array handles by (read-only, zero-copy) arrays
+        self.data_dict = {name: arr.attach() if isinstance(arr, SharedArrayRef) else arr
+                          for name, arr in self.data_dict.items()}
+        for attr in self.shared_array_attributes:
+            if isinstance(getattr(self, attr), SharedArrayRef):
+                setattr(self, attr, getattr(self, attr).attach())
+
+    def make_Q_parallel(self, irrep, by_parts=True, debug=False, num_processors=None, transport=None,
+                        domains_per_task=1, cols_per_task=None, cols=None):
+        # symbolic manipulations are done once here and shipped to the workers with the plan
+        # transport: None to pickle the whole dataset for every worker, 'shm' (shared memory) or 'memmap' (.npy files)
+        # to send only a descriptor and let workers attach to the data arrays
+        # work is split into tiles of domains_per_task domains x cols_per_task columns (None = all columns); tiles are
+        # handed out as workers become free and their timings are stored in task_timings[irrep]
+        # cols: only compute these columns of Q (None = all), e.g. the ones missing from result_cache_dir
+        plan = self.get_plan(irrep, by_parts, debug)
+        cols = list(range(len(plan.terms))) if cols is None else list(cols)
+        n_domains, n_cols = len(self.domains), len(cols)
+        cols_per_task = n_cols if cols_per_task is None else cols_per_task
+        tiles = [(list(range(d, min(d+domains_per_task, n_domains))), cols[c:c+cols_per_task])
+                 for d in range(0, n_domains, domains_per_task) for c in range(0, n_cols, max(cols_per_task, 1))]
+        positions = {col: j for j, col in enumerate(cols)} # column of the result holding each column of the plan
+
+        Q_matrix = np.zeros((plan.n_rows * n_domains, n_cols), dtype=np.float64)
+        self.task_timings[irrep] = []
+        with SharedArrayPool(transport) if transport is not None else contextlib.nullcontext() as pool:
+            dataset = self.make_shared_descriptor(pool) if pool is not None else self
+            init_args = (dataset, {irrep: plan}, debug, weight_cache.max_bytes)
+            #begin parallel task execution
+            with concurrent.futures.ProcessPoolExecutor(max_workers=num_processors, initializer=init_domain_worker, initargs=init_args) as executor:
+                futures = [executor.submit(parallel_tile_task, irrep, domain_indices, cols)
+                           for domain_indices, cols in tiles]
+                for future in concurrent.futures.as_completed(futures):
+                    domain_indices, tile_cols, blocks, timing = future.result()
+                    for d, block in zip(domain_indices, blocks):
+                        Q_matrix[d::n_domains, [positions[col] for col in tile_cols]] = block
+                    self.task_timings[irrep].append(timing)
+        if debug:
+            seconds = [timing['seconds'] for timing in self.task_timings[irrep]]
+            print(f"{len(seconds)} tasks: mean {np.mean(seconds):.3g}s, max {np.max(seconds):.3g}s")
         return Q_matrix
 
-        
-    def make_library_matrices(self, by_parts=True, debug=False, parallel=False, num_processors=None): # compute LibraryData Q matrices
+    def make_Q_all_parallel(self, by_parts=True, debug=False, num_processors=None, transport=None,
+                            domains_per_task=1, irreps=None, cols=None): # compute Q matrices of all irreps with a single process pool
+        # each task evaluates every irrep on a group of domains, so primes shared between irreps are computed once
+        # per domain, and the pool (with its copy of the dataset) is only started once
+        # cols: irrep -> columns of its Q to compute (None/missing = all)
+        irreps = self.irreps if irreps is None else irreps
+        plans = {irrep: self.get_plan(irrep, by_parts, debug) for irrep in irreps}
+        cols = {irrep: irrep_cols for irrep, irrep_cols in (cols or dict()).items() if irrep_cols is not None}
+        n_domains = len(self.domains)
+        Qs = {irrep: np.zeros((plan.n_rows * n_domains, len(cols.get(irrep, plan.terms))), dtype=np.float64)
+              for irrep, plan in plans.items()}
+        self.task_timings['all'] = []
+        with SharedArrayPool(transport) if transport is not None else contextlib.nullcontext() as pool:
+            dataset = self.make_shared_descriptor(pool) if pool is not None else self
+            init_args = (dataset, plans, debug, weight_cache.max_bytes)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=num_processors, initializer=init_domain_worker, initargs=init_args) as executor:
+                futures = [executor.submit(parallel_all_irreps_task, list(range(d, min(d+domains_per_task, n_domains))),
+                                           cols) for d in range(0, n_domains, domains_per_task)]
+                for future in concurrent.futures.as_completed(futures):
+                    domain_indices, blocks, timing = future.result()
+                    for irrep, irrep_blocks in blocks.items():
+                        for d, block in zip(domain_indices, irrep_blocks):
+                            Qs[irrep][d::n_domains, :] = block
+                    self.task_timings['all'].append(timing)
+        if debug:
+            seconds = [timing['seconds'] for timing in self.task_timings['all']]
+            print(f"{len(seconds)} tasks: mean {np.mean(seconds):.3g}s, max {np.max(seconds):.3g}s")
+        return Qs
+
+    def make_library_matrices(self, by_parts=True, debug=False, parallel=False, num_processors=None,
+                              batched=False, domain_major=False, transport=None, domains_per_task=1,
+                              cols_per_task=None, single_pool=False, batch_size=None): # compute LibraryData Q matrices
+        # single_pool: with parallel=True, evaluate all irreps with one pool instead of one pool per irrep
+        # batch_size: with batched=True, domains evaluated at once (None = as many as fit in batch_bytes)
+        # if result_cache_dir is set, cached columns of Q are loaded and only the missing ones are computed
+        use_cache = self.result_cache_dir is not None
+        if parallel and single_pool:
+            # with result_cache_dir, the pool only computes the columns missing from the cache (see make_Q_cached)
+            cols = {irrep: self.missing_columns(irrep, by_parts) if use_cache else None for irrep in self.irreps}
+            cols = {irrep: None if irrep_cols is not None and len(irrep_cols) == len(self.libs[irrep].terms)
+                    else irrep_cols for irrep, irrep_cols in cols.items()}
+            pool_irreps = [irrep for irrep in self.irreps if cols[irrep] != []] # (fully cached ones never need Qs)
+            Qs = self.make_Q_all_parallel(by_parts, debug, num_processors, transport, domains_per_task,
+                                          pool_irreps, cols) if pool_irreps else dict()
         for irrep in self.irreps:
             if debug:
                 print(f"***RANK {irrep} LIBRARY***")
-            if parallel:
-                self.libs[irrep].Q = self.make_Q_parallel(irrep, by_parts, debug, num_processors)
+            if parallel and single_pool:
+                compute_Q = lambda cols: Qs[irrep]
+            elif parallel:
+                compute_Q = lambda cols: self.make_Q_parallel(irrep, by_parts, debug, num_processors, transport,
+                                                              domains_per_task, cols_per_task, cols)
+            elif batched:
+                compute_Q = lambda cols: self.make_Q_batched(irrep, by_parts, debug, batch_size) if cols is None \
+                    else self.make_Q_columns(irrep, cols, by_parts, debug)
+            elif domain_major:
+                compute_Q = lambda cols: self.make_Q_domain_major(irrep, by_parts, debug) if cols is None \
+                    else self.make_Q_columns(irrep, cols, by_parts, debug)
             else:
-                self.libs[irrep].Q = self.make_Q(irrep, by_parts, debug)
+                compute_Q = lambda cols: self.make_Q(irrep, by_parts, debug) if cols is None \
+                    else self.make_Q_columns(irrep, cols, by_parts, debug)
+            self.libs[irrep].Q = self.make_Q_cached(irrep, by_parts, debug, compute_Q) if use_cache else compute_Q(None)
+            self.libs[irrep].Q_keys = self.Q_keys(irrep, by_parts)
+        self.find_col_weights()
+
+    def find_col_weights(self): # (re)compute characteristic scales and col_weights of every library
         self.find_scales()
         for irrep in self.irreps:
             self.libs[irrep].col_weights = [self.get_char_size(term) for term in self.libs[irrep].terms]
             #print('Irrep', irrep, '; weights', self.libs[irrep].col_weights)
         #self.find_row_weights()
 
+    ### incremental updates: change terms/weights/domains, then call update_library_matrices
+    def Q_keys(self, irrep, by_parts=True): # keys of the columns, weights and domains of a Q matrix
+        return ([repr(term) for term in self.libs[irrep].terms], [repr(weight) for weight in self.weights],
+                [repr(domain) for domain in self.domains], by_parts)
+
+    def add_terms(self, irrep, terms): # append terms that are not in the library yet
+        lib = self.libs[irrep]
+        lib.terms = list(lib.terms) + [term for term in terms if term not in lib.terms]
+
+    def remake_libraries(self, **kwargs): # make_libraries (e.g. with a higher complexity), keeping the Q matrices
+        old_libs = self.libs
+        self.make_libraries(**kwargs)
+        for irrep, lib in self.libs.items():
+            if irrep in old_libs:
+                lib.Q, lib.Q_keys = old_libs[irrep].Q, old_libs[irrep].Q_keys
+
+    def add_weights(self, m, qmax): # make_weights with new parameters (existing weights keep their rows)
+        self.make_weights(m, qmax)
+
+    def add_domains(self, ndomains, domain_size, pad=0): # append ndomains new domains (of the same size)
+        old_domains = self.domains
+        self.make_domains(ndomains, domain_size, pad)
+        self.domains = old_domains + self.domains
+
+    def update_Q(self, irrep, by_parts=True, debug=False): # bring Q up to date, computing only the missing entries
+        lib = self.libs[irrep]
+        new_keys = self.Q_keys(irrep, by_parts)
+        if lib.Q is None or lib.Q_keys is None or lib.Q_keys[3] != by_parts:
+            return self.make_Q(irrep, by_parts, debug)
+        (old_terms, old_weights, old_domains, _), (terms, weights, domains, _) = lib.Q_keys, new_keys
+        plan = self.get_plan(irrep, by_parts, debug)
+        n_tws = plan.n_rows // len(weights) # rows per base weight
+        # view Q as (weight, tensor weight, domain, term), which is how its rows are ordered
+        old_Q = lib.Q.reshape(len(old_weights), n_tws, len(old_domains), len(old_terms))
+        Q = np.zeros((len(weights), n_tws, len(domains), len(terms)))
+        def matches(new, old): # indices of entries of new that are found in old, and where
+            old_index = {key: i for i, key in enumerate(old)}
+            pairs = [(i, old_index[key]) for i, key in enumerate(new) if key in old_index]
+            return [i for i, _ in pairs], [j for _, j in pairs]
+        (w_new, w_old), (d_new, d_old), (c_new, c_old) = (matches(weights, old_weights),
+                                                          matches(domains, old_domains), matches(terms, old_terms))
+        Q[np.ix_(w_new, range(n_tws), d_new, c_new)] = old_Q[np.ix_(w_old, range(n_tws), d_old, c_old)]
+        # missing entries: new domains x everything, old domains x (new terms + new weights x old terms)
+        new_cols = [j for j in range(len(terms)) if j not in c_new]
+        new_weights = [i for i in range(len(weights)) if i not in w_new]
+        plan_weights = plan.make_weights(self.weights)
+        for d, domain in enumerate(self.domains):
+            if d in d_new:
+                blocks = [(new_cols, None), (c_new, new_weights)]
+            else:
+                blocks = [(list(range(len(terms))), None)]
+            for cols, weight_indices in blocks:
+                if not cols or weight_indices == []:
+                    continue
+                block = self.eval_plan_on_domain(plan, plan_weights, domain, cols=cols, debug=debug,
+                                                 weight_indices=weight_indices)
+                block = block.reshape(len(weights), n_tws, len(cols))
+                rows = range(len(weights)) if weight_indices is None else weight_indices
+                Q[np.ix_(rows, range(n_tws), [d], cols)] = block[rows][:, :, None, :]
+        if debug:
+            print(f"Reused {len(w_new)*len(d_new)*len(c_new)} of {len(weights)*len(domains)*len(terms)} (weight, domain, term) entries")
+        return Q.reshape(plan.n_rows * len(domains), len(terms))
+
+    def update_library_matrices(self, by_parts=True, debug=False): # incremental version of make_library_matrices
+        for irrep in self.irreps:
+            self.libs[irrep].Q = self.update_Q(irrep, by_parts, debug)
+            self.libs[irrep].Q_keys = self.Q_keys(irrep, by_parts)
+        self.find_col_weights()
+
+    ### ensembles: evaluate Q once on a large pool of domains, then resample domains by selecting rows of Q
+    def draw_domain_samples(self, n_samples, sample_size=None, replace=True, rng=None): # -> list of domain index arrays
+        # sample_size: domains per sample (default: all of them); replace=True gives bootstrap samples,
+        # replace=False subsamples; rng: np.random.Generator (None = the global np.random state)
+        n_domains = len(self.domains)
+        sample_size = n_domains if sample_size is None else sample_size
+        assert replace or sample_size <= n_domains, "Subsamples can't be larger than the pool of domains"
+        choice = rng.choice if rng is not None else np.random.choice
+        return [np.sort(choice(n_domains, size=sample_size, replace=replace)) for i in range(n_samples)]
+
+    def sample_library(self, irrep, domain_indices): # LibraryData with the rows of Q restricted to some domains
+        # (col_weights are kept from the full pool, so that all samples are scaled identically)
+        lib = self.libs[irrep]
+        return replace(lib, Q=lib.Q[domain_rows(lib.Q.shape[0], len(self.domains), domain_indices)], Q_keys=None)
+
     def find_scales(self, names=None): # find mean/std deviation of fields in data_dict that are in names
         pass
 
@@ -622,6 +1247,23 @@ def get_slice(arr, domain):
         arr_slice = arr_slice[tuple(idx)]
     return arr_slice
 
+def domain_rows(n_rows, n_domains, domain_indices): # rows of a Q matrix belonging to (a list of) domains
+    # rows are ordered (weight, tensor weight, domain), i.e. row = block * n_domains + domain; repeated domains
+    # give repeated rows, which is how bootstrap samples are represented
+    domain_indices = np.asarray(domain_indices, dtype=np.int64)
+    return (np.arange(n_rows // n_domains)[:, None] * n_domains + domain_indices[None, :]).ravel()
+
+def save_atomic(filename, *args, **kwds): # np.save (one array) or np.savez (keyword arrays) via a temporary file
+    # so that concurrent readers (e.g. other workers) never see a partially written file
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, 'wb') as f:
+        if kwds:
+            np.savez(f, *args, **kwds)
+        else:
+            np.save(f, *args)
+    os.replace(tmp_filename, filename)
+
 def int_arr(arr, dxs=None):  # integrate an array of values on an integration domain
     if dxs is None:
         dxs = [1] * len(arr.shape)
@@ -632,6 +1274,56 @@ def int_arr(arr, dxs=None):  # integrate an array of values on an integration do
     else:
         return int_arr(integral, dxs[1:])
 
+def trapezoid_weights_1d(n): # quadrature factors matching np.trapz on n points with unit spacing
+    weights = np.ones(n)
+    if n == 1: # trapz of a single point is 0
+        return 0 * weights
+    weights[0] = weights[-1] = 0.5
+    return weights
+
+def fused_integral(arrays, vectors): # sum of prod(arrays) * outer product of vectors, without temporaries
+    # arrays: equally shaped arrays; vectors: one 1D factor per axis (e.g. weights with trapezoid quadrature folded in)
+    if not arrays: # integral of the weight alone factorizes
+        return reduce(mul, [np.sum(vector) for vector in vectors], 1.0)
+    if all(np.isrealobj(array) for array in arrays):
+        # the kernel is compiled per tuple of array types: to keep the number of variants down, the (commuting)
+        # factors are passed as read-only views with the contiguous ones first
+        views = []
+        for array in sorted(arrays, key=lambda array: not array.flags.c_contiguous):
+            view = array.view()
+            view.flags.writeable = False
+            views.append(view)
+        return fused_integral_kernel(tuple(views), tuple(vectors))
+    # complex fields: a single unoptimized einsum (optimize=True would form full-size pairwise intermediates)
+    axes = list(range(len(vectors)))
+    operands = [operand for array in arrays for operand in (array, axes)]
+    operands += [operand for i, vector in enumerate(vectors) for operand in (vector, [i])]
+    return np.einsum(*operands, [], optimize=False)
+
+@jit(nopython=True, cache=True)
+def fused_integral_kernel(arrays, vectors): # compiled loop of fused_integral (one specialization per signature)
+    # walks over the last axis line by line, so only a buffer of one line is allocated
+    shape = arrays[0].shape
+    last = vectors[-1]
+    line_product = np.empty(shape[-1])
+    total = 0.0
+    for outer in np.ndindex(shape[:-1]):
+        w = 1.0
+        for axis in range(len(outer)):
+            w *= vectors[axis][outer[axis]]
+        for i in range(shape[-1]):
+            line_product[i] = w * last[i]
+        for array in literal_unroll(arrays): # the arrays may differ in layout/writeability
+            line = array[outer]
+            for i in range(shape[-1]):
+                line_product[i] *= line[i]
+        for i in range(shape[-1]):
+            total += line_product[i]
+    return total
+
+def trapezoid_weights(shape): # quadrature factors so that (arr * trapezoid_weights(arr.shape)).sum() == int_arr(arr)
+    return reduce(lambda x, y: np.tensordot(x, y, axes=0), [trapezoid_weights_1d(n) for n in shape])
+
 def int_by_parts(term, weight, by_parts=True, dim=0):
     if weight.scale == 0 or not by_parts: # no point - the weight is zero anyway or we were asked not to
         yield term, weight
@@ -722,15 +1414,84 @@ def int_by_parts_dim(term, weight, dim, debug=False):
                 print("Terminate: next derivative too close and doesn't match")
             yield term, weight, True
 
-def diff(data, dorders, dxs=None, acc=6):
+# FinDiff operators and findiff stencils are reused between calls, since the same few derivatives come up repeatedly
+diff_operators = dict() # (dorders, dxs, acc) -> FinDiff
+stencils = dict() # (order, acc) -> {'center'/'forward'/'backward': (coefficients, offsets)}
+
+def get_diff_operator(dorders, dxs, acc=6):
+    key = (tuple(dorders), tuple(float(dx) for dx in dxs), acc)
+    if key not in diff_operators:
+        diff_list = [(i, dx, order) for i, (dx, order) in enumerate(zip(dxs, dorders)) if order > 0]
+        diff_operators[key] = FinDiff(*diff_list, acc=acc)
+    return diff_operators[key]
+
+def get_stencils(order, acc=6):
+    if (order, acc) not in stencils:
+        stencils[order, acc] = {scheme: (np.array(coefs['coefficients'], dtype=np.float64), np.array(coefs['offsets']))
+                                for scheme, coefs in findiff_coefficients(deriv=order, acc=acc).items()}
+    return stencils[order, acc]
+
+def diff_1d(data, axis, order, dx, acc=6): # same as FinDiff((axis, dx, order), acc=acc)(data) using cached stencils
+    center_coefs, center_offsets = get_stencils(order, acc)['center']
+    n_bndry = len(center_coefs) // 2 # like findiff, this many points at each end get one-sided stencils
+    n = data.shape[axis]
+    out = scipy.ndimage.correlate1d(data, center_coefs, axis=axis, mode='constant')
+    data_view, out_view = np.moveaxis(data, axis, 0), np.moveaxis(out, axis, 0)
+    for scheme, points in (('forward', range(n_bndry)), ('backward', range(n - n_bndry, n))):
+        coefs, offsets = get_stencils(order, acc)[scheme]
+        for i in points:
+            out_view[i] = np.tensordot(coefs, data_view[i + offsets], axes=1)
+    return out * (1.0 / dx**order)
+
+def diff(data, dorders, dxs=None, acc=6, compiled=True):
     # for spatial directions can use finite differences or spectral differentiation. For time, only the former.
     # in any case, it's probably best to pre-compute the derivatives on the whole domains (at least up to order 2).
     # with integration by parts, there shouldn't be higher derivatives.
+    # compiled: apply cached stencils one axis at a time (same result as findiff up to rounding, less overhead)
     if dxs is None:
         dxs = [1] * len(dorders)
-    diff_list = []
-    for i, dx, order in zip(range(len(dxs)), dxs, dorders):
+    if not compiled:
+        return get_diff_operator(dorders, dxs, acc)(data)
+    data = np.asarray(data, dtype=np.result_type(data, np.float64))
+    for axis, (dx, order) in enumerate(zip(dxs, dorders)):
         if order > 0:
-            diff_list.append((i, dx, order))
-    diff_operator = FinDiff(*diff_list, acc=acc)
-    return diff_operator(data)
\ No newline at end of file
+            data = diff_1d(data, axis, order, dx, acc)
+    return data
+
+def diff_chunked(data, dorders, dxs=None, acc=6, chunk_size=None, out=None):
+    # same as diff(data, dorders, dxs, acc), computed chunk_size slices of the last (time) axis at a time
+    # out: optional array (e.g. a memmap) to write the result into
+    if out is None:
+        out = np.empty(data.shape, dtype=np.result_type(data.dtype, np.float64))
+    n_t = data.shape[-1]
+    chunk_size = n_t if chunk_size is None else chunk_size
+    # chunks are padded by twice the width of a one-sided stencil (findiff applies those to a band of boundary
+    # points), so that every chunk is long enough and stencils of points kept never see the edges of a chunk
+    halo = 2 * (dorders[-1] + acc) if dorders[-1] > 0 else 0
+    for start in range(0, n_t, chunk_size):
+        stop = min(start + chunk_size, n_t)
+        lo, hi = max(0, start - halo), min(n_t, stop + halo)
+        out[..., start:stop] = diff(data[..., lo:hi], dorders, dxs, acc)[..., start - lo:stop - lo]
+    return out
+
+def spectral_diff(data, dorders, dxs=None, axes=None, transform=None):
+    # differentiate data, which must be periodic along axes (default: all), in Fourier space
+    # transform: np.fft.rfftn(data, axes=axes) if it has already been computed
+    axes = list(range(len(dorders))) if axes is None else list(axes)
+    assert all(order == 0 for i, order in enumerate(dorders) if i not in axes), "Non-periodic axis differentiated"
+    if dxs is None:
+        dxs = [1] * len(dorders)
+    if transform is None:
+        transform = np.fft.rfftn(data, axes=axes)
+    multiplier = np.ones(1, dtype=np.complex128)
+    for axis in axes:
+        n, order = data.shape[axis], dorders[axis]
+        # rfftn halves the last of the axes
+        k = 2 * np.pi * (np.fft.rfftfreq(n, dxs[axis]) if axis == axes[-1] else np.fft.fftfreq(n, dxs[axis]))
+        factor = (1j * k) ** order
+        if order % 2 == 1 and n % 2 == 0: # the Nyquist mode has no consistent odd derivative
+            factor[n // 2] = 0
+        shape = [1] * data.ndim
+        shape[axis] = len(factor)
+        multiplier = multiplier * factor.reshape(shape)
+    return np.fft.irfftn(transform * multiplier, s=[data.shape[axis] for axis in axes], axes=axes)
\ No newline at end of file
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# shared memory segments attached in this process (they have to stay referenced while their arrays are in use)
+attached_segments = dict()
+
+@dataclass(frozen=True)
+class SharedArrayRef(object): # picklable handle to an array living in shared memory or in a .npy file
+    shape: tuple[int, ...]
+    dtype: str
+    shm_name: str = None # name of the shared memory block (mode 'shm')
+    filename: str = None # path of the .npy file (mode 'memmap')
+
+    def attach(self): # zero-copy, read-only view of the array
+        if self.filename is not None:
+            return np.load(self.filename, mmap_mode='r')
+        if self.shm_name not in attached_segments:
+            attached_segments[self.shm_name] = shared_memory.SharedMemory(name=self.shm_name)
+        arr = np.ndarray(self.shape, dtype=np.dtype(self.dtype), buffer=attached_segments[self.shm_name].buf)
+        arr.flags.writeable = False
+        return arr
+
+class SharedArrayPool(object): # creates shared copies of arrays and releases them on exit
+    def __init__(self, mode='shm', directory=None):
+        # mode: 'shm' for multiprocessing.shared_memory, 'memmap' for memory-mapped .npy files in directory
+        assert mode in ('shm', 'memmap'), f"Unknown shared array mode {mode}"
+        self.mode = mode
+        self.directory = directory
+        self.own_directory = False
+        self.segments = []
+        self.filenames = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def share(self, arr): # copy arr into shared storage once and return a handle that can be sent to workers
+        arr = np.ascontiguousarray(arr)
+        if self.mode == 'memmap':
+            if self.directory is None:
+                self.directory = tempfile.mkdtemp(prefix='pyspider_')
+                self.own_directory = True
+            filename = os.path.join(self.directory, f"shared_{len(self.filenames)}.npy")
+            np.save(filename, arr)
+            self.filenames.append(filename)
+            return SharedArrayRef(shape=arr.shape, dtype=arr.dtype.str, filename=filename)
+        segment = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=segment.buf)[...] = arr
+        self.segments.append(segment)
+        return SharedArrayRef(shape=arr.shape, dtype=arr.dtype.str, shm_name=segment.name)
+
+    def close(self):
+        for segment in self.segments:
+            attached_segments.pop(segment.name, None)
+            segment.close()
+            segment.unlink()
+        self.segments = []
+        for filename in self.filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+        self.filenames = []
+        if self.own_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory, self.own_directory = None, False
@@ -0,0 +1,255 @@
+import itertools
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+def normalize_key(key, shape): # basic indexing key -> list of (start, stop, is_int) over every axis
+    key = key if isinstance(key, tuple) else (key,)
+    if Ellipsis in key:
+        i = key.index(Ellipsis)
+        key = key[:i] + (slice(None),) * (len(shape) - len(key) + 1) + key[i+1:]
+    key = key + (slice(None),) * (len(shape) - len(key))
+    bounds = []
+    for k, n in zip(key, shape):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(n)
+            assert step == 1, "Only contiguous slices are supported"
+            bounds.append((start, max(start, stop), False))
+        else:
+            k = int(k) + n if int(k) < 0 else int(k)
+            bounds.append((k, k + 1, True))
+    return bounds
+
+def chunks_touched(bounds, chunks): # ranges of chunk indices along each axis covering the window
+    return [range(start // c, (stop - 1) // c + 1) if stop > start else range(0)
+            for (start, stop, _), c in zip(bounds, chunks)]
+
+def assemble_window(bounds, chunks, dtype, get_chunk): # window of a chunked array from get_chunk(chunk index)
+    out = np.empty([stop - start for start, stop, _ in bounds], dtype=dtype)
+    for index in itertools.product(*chunks_touched(bounds, chunks)):
+        chunk = get_chunk(index)
+        # intersection of the chunk and the window, in chunk and in window coordinates
+        lo = [max(start, i * c) for (start, stop, _), i, c in zip(bounds, index, chunks)]
+        hi = [min(stop, (i + 1) * c) for (start, stop, _), i, c in zip(bounds, index, chunks)]
+        out[tuple(slice(l - start, h - start) for l, h, (start, _, _) in zip(lo, hi, bounds))] = \
+            chunk[tuple(slice(l - i * c, h - i * c) for l, h, i, c in zip(lo, hi, index, chunks))]
+    return out[tuple(0 if is_int else slice(None) for _, _, is_int in bounds)]
+
+class ChunkedDirectoryArray(object): # read-only array stored as one file per chunk (uncompressed zarr v2 layout)
+    # path/.zarray holds the metadata (shape, chunks, dtype, fill_value, order); chunk (i, j, ...) is stored as raw
+    # bytes of a full chunk in path/i.j...; this reads arrays written by zarr with compressor=None, without zarr
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, '.zarray')) as f:
+            meta = json.load(f)
+        assert meta.get('compressor') is None and not meta.get('filters'), "Only uncompressed arrays are supported"
+        self.shape = tuple(meta['shape'])
+        self.chunks = tuple(meta['chunks'])
+        self.dtype = np.dtype(meta['dtype'])
+        self.fill_value = meta.get('fill_value') or 0
+        self.order = meta.get('order', 'C')
+        self.separator = meta.get('dimension_separator', '.')
+        self.bytes_read = 0 # bytes loaded from chunk files
+        self.chunks_read = 0
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def read_chunk(self, index):
+        filename = os.path.join(self.path, self.separator.join(str(i) for i in index))
+        if not os.path.exists(filename): # chunks that were never written are filled in
+            return np.full(self.chunks, self.fill_value, dtype=self.dtype)
+        chunk = np.fromfile(filename, dtype=self.dtype).reshape(self.chunks, order=self.order)
+        self.bytes_read += chunk.nbytes
+        self.chunks_read += 1
+        return chunk
+
+    def __getitem__(self, key):
+        return assemble_window(normalize_key(key, self.shape), self.chunks, self.dtype, self.read_chunk)
+
+    def __array__(self, dtype=None, copy=None):
+        return self[...] if dtype is None else self[...].astype(dtype)
+
+def save_chunked_directory(path, arr, chunks): # write arr in the layout read by ChunkedDirectoryArray
+    os.makedirs(path, exist_ok=True)
+    arr = np.asarray(arr)
+    with open(os.path.join(path, '.zarray'), 'w') as f:
+        json.dump({'zarr_format': 2, 'shape': list(arr.shape), 'chunks': list(chunks), 'dtype': arr.dtype.str,
+                   'compressor': None, 'filters': None, 'fill_value': 0, 'order': 'C'}, f)
+    for index in itertools.product(*(range(-(-n // c)) for n, c in zip(arr.shape, chunks))):
+        chunk = np.zeros(chunks, dtype=arr.dtype)
+        block = arr[tuple(slice(i * c, (i + 1) * c) for i, c in zip(index, chunks))]
+        chunk[tuple(slice(0, n) for n in block.shape)] = block # edge chunks are padded to full size
+        chunk.tofile(os.path.join(path, '.'.join(str(i) for i in index)))
+
+def open_data_dict(path, names=None): # on-disk arrays (to be used as SRDataset.data_dict) from HDF5 or a directory
+    # path: HDF5 file with one dataset per observable, or a directory with one ChunkedDirectoryArray per observable
+    if os.path.isdir(path):
+        names = [name for name in sorted(os.listdir(path)) if os.path.exists(os.path.join(path, name, '.zarray'))] \
+            if names is None else names
+        return {name: ChunkedDirectoryArray(os.path.join(path, name)) for name in names}
+    import h5py # optional dependency
+    f = h5py.File(path, 'r')
+    names = [name for name in f if isinstance(f[name], h5py.Dataset)] if names is None else names
+    return {name: f[name] for name in names}
+
+class StreamingSource(object): # read-only view of an on-disk array (HDF5 dataset, np.memmap, ...) read window by window
+    # array: h5py.Dataset, np.memmap or anything with shape, dtype and numpy-style slicing
+    # time_axis: axis of the array that indexes time (the axis after the spatial ones)
+    # buffer_steps: read-ahead buffer length; a read loads at least this many time steps of the full array starting
+    # at the requested one, so that domains close in time are served from memory (0 = read exactly what is needed)
+    # cache_bytes: memory for storage chunks of a chunked array kept in memory (least recently used ones are dropped),
+    # so that nearby domains share chunk reads; used instead of the read-ahead buffer (0 = no chunk cache); the chunks
+    # of the last window read are always kept, so a budget smaller than one (padded) window acts as that window's size
+    def __init__(self, array, time_axis, buffer_steps=0, cache_bytes=0):
+        self.array = array
+        self.time_axis = time_axis
+        self.buffer_steps = buffer_steps
+        self.cache_bytes = cache_bytes
+        self.shape = tuple(array.shape)
+        self.dtype = np.dtype(array.dtype)
+        self.ndim = len(self.shape)
+        self.location = self.find_location(array) # how to reopen the array after pickling
+        self.chunks = getattr(array, 'chunks', None) # storage chunk shape (None = contiguous)
+        self.buffer = None
+        self.buffer_times = (0, 0)
+        self.chunk_cache = OrderedDict() # chunk index -> chunk, in order of last use
+        self.chunk_cache_bytes = 0
+        self.bytes_read = 0
+
+    @staticmethod
+    def from_hdf5(filename, dataset_name, time_axis, buffer_steps=0, cache_bytes=0):
+        import h5py # optional dependency
+        return StreamingSource(h5py.File(filename, 'r')[dataset_name], time_axis, buffer_steps, cache_bytes)
+
+    @staticmethod
+    def find_location(array):
+        if isinstance(array, np.memmap) and array.filename is not None:
+            return ('memmap', array.filename, array.dtype.str, array.shape, array.offset,
+                    'F' if array.flags.f_contiguous and not array.flags.c_contiguous else 'C')
+        if type(array).__module__.startswith('h5py'):
+            return ('hdf5', array.file.filename, array.name)
+        if isinstance(array, ChunkedDirectoryArray):
+            return ('directory', array.path)
+        return None # kept as is (must be picklable to be sent to parallel workers)
+
+    def content_key(self): # stands in for the contents in AbstractDataset.data_hash (without reading the data)
+        # covers the location, shape and dtype and the size and modification time of the file(s) holding the data, so
+        # a file rewritten in place gets a new key; arrays without a location (None) are only identified by location
+        files = []
+        match self.location:
+            case ('memmap', filename, *_) | ('hdf5', filename, _):
+                files = [filename]
+            case ('directory', path):
+                files = sorted(os.path.join(path, name) for name in os.listdir(path))
+        stats = [(os.path.basename(filename), os.stat(filename).st_size, os.stat(filename).st_mtime_ns)
+                 for filename in files if os.path.exists(filename)]
+        return (self.location, self.shape, self.dtype.str, stats)
+
+    def open(self): # (re)open the underlying array from its location
+        match self.location:
+            case ('memmap', filename, dtype, shape, offset, order):
+                self.array = np.memmap(filename, dtype=np.dtype(dtype), mode='r', shape=shape, offset=offset, order=order)
+            case ('hdf5', filename, dataset_name):
+                import h5py
+                self.array = h5py.File(filename, 'r')[dataset_name]
+            case ('directory', path):
+                self.array = ChunkedDirectoryArray(path)
+
+    def __getstate__(self): # ship only the location (and not the buffer) to other processes
+        state = self.__dict__.copy()
+        state['buffer'], state['buffer_times'] = None, (0, 0)
+        state['chunk_cache'], state['chunk_cache_bytes'] = OrderedDict(), 0
+        if self.location is not None:
+            state['array'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.array is None:
+            self.open()
+
+    def __repr__(self):
+        return f"StreamingSource({self.location if self.location is not None else type(self.array).__name__}, shape={self.shape})"
+
+    def __getitem__(self, key): # plain read (e.g. the full array), bypassing the buffer
+        arr = np.asarray(self.array[key])
+        self.bytes_read += self.io_bytes(key) if self.chunks is not None else arr.nbytes
+        return arr
+
+    def io_bytes(self, key): # bytes of storage read for a window of a chunked array (whole chunks are read)
+        n_chunks = np.prod([len(r) for r in chunks_touched(normalize_key(key, self.shape), self.chunks)])
+        return int(n_chunks * np.prod(self.chunks)) * self.dtype.itemsize
+
+    def read(self, min_corner, max_corner, obs_inds=()): # window [min_corner, max_corner] (inclusive) of components
+        window = tuple(slice(lo, hi + 1) for lo, hi in zip(min_corner, max_corner))
+        t_min, t_max = min_corner[self.time_axis], max_corner[self.time_axis]
+        if self.cache_bytes > 0 and self.chunks is not None:
+            bounds = normalize_key(window, self.shape)
+            out = assemble_window(bounds, self.chunks, self.dtype, self.get_chunk)
+            # drop least recently used chunks, but not the ones of this window (the most recently used ones)
+            n_window_chunks = np.prod([len(r) for r in chunks_touched(bounds, self.chunks)])
+            while self.chunk_cache_bytes > self.cache_bytes and len(self.chunk_cache) > n_window_chunks:
+                self.chunk_cache_bytes -= self.chunk_cache.popitem(last=False)[1].nbytes
+            return out[(*[slice(None)] * len(window), *obs_inds)]
+        if self.buffer_steps <= 0:
+            return self[(*window, *obs_inds)]
+        if not (self.buffer_times[0] <= t_min and t_max < self.buffer_times[1]): # read ahead from t_min
+            t_stop = min(self.shape[self.time_axis], t_min + max(self.buffer_steps, t_max - t_min + 1))
+            time_slice = [slice(None)] * self.ndim
+            time_slice[self.time_axis] = slice(t_min, t_stop)
+            self.buffer = None # release the old buffer before reading the new one
+            self.buffer = self[tuple(time_slice)]
+            self.buffer_times = (t_min, t_stop)
+        buffer_window = list(window)
+        buffer_window[self.time_axis] = slice(t_min - self.buffer_times[0], t_max + 1 - self.buffer_times[0])
+        return self.buffer[(*buffer_window, *obs_inds)]
+
+    def get_chunk(self, index): # storage chunk through the chunk cache (bytes_read counts the chunks read)
+        if index in self.chunk_cache:
+            self.chunk_cache.move_to_end(index)
+            return self.chunk_cache[index]
+        chunk = self[tuple(slice(i * c, min((i + 1) * c, n)) for i, c, n in zip(index, self.chunks, self.shape))]
+        self.chunk_cache[index] = chunk
+        self.chunk_cache_bytes += chunk.nbytes
+        return chunk
+
+    def iter_time_chunks(self, chunk_steps=None): # consecutive blocks of time steps of the full array
+        if chunk_steps is None: # default: the buffer length, or about 64 MB
+            step_bytes = self.dtype.itemsize * np.prod(self.shape) // self.shape[self.time_axis]
+            chunk_steps = max(1, self.buffer_steps, 2**26 // step_bytes)
+        for start in range(0, self.shape[self.time_axis], chunk_steps):
+            time_slice = [slice(None)] * self.ndim
+            time_slice[self.time_axis] = slice(start, start + chunk_steps)
+            yield self[tuple(time_slice)]
+
+class RunningStats(object): # one-pass mean/variance of a stream of arrays (Welford's algorithm, merged chunkwise)
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0 # sum of squared deviations from the mean
+        self.sum_squares = 0.0
+
+    def update(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if chunk.size == 0:
+            return
+        count, mean = chunk.size, np.mean(chunk)
+        m2 = np.sum((chunk - mean) ** 2)
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.sum_squares += np.sum(chunk ** 2)
+
+    @property
+    def std(self): # same as np.std of all values seen
+        return np.sqrt(self.m2 / self.count)
+
+    @property
+    def rms(self): # same as np.linalg.norm of all values / sqrt(number of values)
+        return np.sqrt(self.sum_squares / self.count)
@@ -1,36 +1,218 @@
 from PySPIDER.commons.process_library_terms import *
 from PySPIDER.continuous.library import *
+from PySPIDER.continuous.data_sources import StreamingSource, RunningStats, open_data_dict
 
+@dataclass(kw_only=True)
 class SRDataset(AbstractDataset):
+    # 'findiff' (finite differences on each domain), 'global' (finite differences on whole fields, served as slices),
+    # 'auto' (whichever of the two is cheaper for the domains) or 'spectral' (FFT of whole periodic fields)
+    diff_method: str = 'findiff'
+    periodic_dims: List[int] = None # dimensions differentiated spectrally when diff_method='spectral' (None = all spatial)
+    global_coverage: float = 1 # 'auto' switches to 'global' when the domains cover this many times the grid
+    global_chunk_size: int = None # time steps per chunk when differentiating whole fields (None = all at once)
+    global_field_dir: str = None # directory for memory-mapped whole-field derivatives (None = keep in memory)
+    derivative_lattice: bool = True # differentiate primes starting from cached derivatives of the same observable
+    # data_dict entries that aren't in-memory arrays (np.memmap, h5py datasets, ...) are wrapped in StreamingSources,
+    # which read only the windows needed; this is their read-ahead buffer length in time steps
+    stream_buffer_steps: int = 0
+    # memory for storage chunks of each streamed entry (see StreamingSource.cache_bytes); to share reads between
+    # domains it should hold at least the chunks that a domain window (plus stencil halo) touches (0 = no chunk cache)
+    stream_cache_bytes: int = 0
+    chunk_aligned: bool = False # default of make_domains(chunk_aligned=...), also used by resample
+    # derivatives (and Fourier transforms) of observables on the full grid: (kind, name, obs_inds, orders) -> array
+    global_fields: Dict[tuple, np.ndarray] = field(default_factory=dict)
+
     #field_dict: dict[tuple[Any], np.ndarray[float]] = None # storage of computed coarse-grained quantities: (prim, dims, domains) -> array
-    def make_domains(self, ndomains, domain_size, pad=0):
+
+    def __post_init__(self):
+        super().__post_init__()
+        # (name, obs_inds, domain) -> {derivative orders: prime} of primes evaluated by finite differences
+        self.derivative_index = dict()
+        self.domain_bytes_read = dict() # domain -> bytes read from streamed data_dict entries to evaluate it
+        self.data_dict = {name: StreamingSource(arr, time_axis=self.n_dimensions-1, buffer_steps=self.stream_buffer_steps,
+                                                cache_bytes=self.stream_cache_bytes)
+                          if isinstance(arr, np.memmap) or not isinstance(arr, (np.ndarray, StreamingSource)) else arr
+                          for name, arr in self.data_dict.items()}
+
+    def make_domains(self, ndomains, domain_size, pad=0, sampler=None, chunk_aligned=None):
+        # sampler: DomainSampler (default: domain_sampler)
+        # chunk_aligned: order the domains by the storage chunks of the data they start in, so that domains sharing
+        # chunks are evaluated one after the other and (with stream_cache_bytes) read them only once; the corners
+        # themselves are drawn as usual, so every grid point keeps the same chance of being covered (None = keep the
+        # chunk_aligned field, otherwise the field is set)
+        if chunk_aligned is not None:
+            self.chunk_aligned = chunk_aligned
         self.domains = []
         self.domain_size = domain_size
-        for i in range(ndomains):
-            min_corner = []
-            max_corner = []
-            for (L, max_lim) in zip(domain_size, self.world_size):
-                num = np.random.randint(pad, max_lim - (L + pad) + 1)
-                min_corner.append(num)
-                max_corner.append(num + L - 1)
+        allowed_starts = [range(pad, max_lim - (L + pad) + 1) for (L, max_lim) in zip(domain_size, self.world_size)]
+        for min_corner in self.get_domain_sampler(sampler).sample(ndomains, allowed_starts, domain_size):
+            max_corner = [num + L - 1 for num, L in zip(min_corner, domain_size)]
             self.domains.append(IntegrationDomain(min_corner, max_corner))
+        chunks = self.get_chunks() if self.chunk_aligned else None
+        if chunks is not None: # time chunk first, as consecutive time steps are usually stored together
+            self.domains.sort(key=lambda domain: [domain.min_corner[-1] // chunks[-1]] +
+                                                 [c // chunk for c, chunk in zip(domain.min_corner[:-1], chunks[:-1])])
         self.pad = 0
         #return domains
 
-    def eval_prime(self, prime, domain):
+    def prime_orders(self, prime): # observable name, component indices and derivative orders along each axis
         name = prime.derivand.string
         obs_inds = [idx.value for idx in prime.derivand.indices] # unpack the indices
         #print(obs_inds)
 
-        data_arr = self.data_dict[name][..., *obs_inds]
-        data_slice = get_slice(data_arr, domain)
-
         orders = prime.derivative.get_spatial_orders()
         dimorders = [orders[LiteralIndex(i)] for i in range(self.n_dimensions-1)]
         dimorders += [prime.derivative.torder]
         #print(prime.derivative, dimorders)
+        return name, obs_inds, dimorders
+
+    def split_spectral_orders(self, dimorders): # -> (orders done spectrally, orders left for finite differences)
+        periodic_dims = self.get_periodic_dims()
+        return ([order if i in periodic_dims else 0 for i, order in enumerate(dimorders)],
+                [0 if i in periodic_dims else order for i, order in enumerate(dimorders)])
+
+    def eval_prime(self, prime, domain):
+        name, obs_inds, dimorders = self.prime_orders(prime)
+        diff_method = self.get_diff_method()
+        data_slice = None
+        if diff_method == 'global' and sum(dimorders)>0:
+            if isinstance(self.data_dict[name], StreamingSource): # never hold whole streamed fields in memory
+                return self.eval_window(self.data_dict[name], obs_inds, dimorders, domain)
+            return get_slice(self.get_global_field(name, obs_inds, dimorders), domain)
+        if diff_method == 'spectral' and sum(dimorders)>0:
+            # periodic dimensions are differentiated on the whole grid; the rest with finite differences on the slice
+            spectral_orders, dimorders = self.split_spectral_orders(dimorders)
+            data_slice = get_slice(self.get_spectral_field(name, obs_inds, spectral_orders), domain)
+        elif self.derivative_lattice and self.cache_primes and sum(dimorders)>0:
+            lattice_key = (name, tuple(obs_inds), domain)
+            ancestor_orders, ancestor_slice = self.find_derivative_ancestor(lattice_key, dimorders)
+            self.derivative_index.setdefault(lattice_key, dict())[tuple(dimorders)] = prime
+            if ancestor_slice is not None: # only the missing 1D stencils are left to apply
+                data_slice = ancestor_slice
+                dimorders = [order - ancestor_order for order, ancestor_order in zip(dimorders, ancestor_orders)]
+        if data_slice is None:
+            data_slice = self.get_data_slice(name, obs_inds, domain)
         return diff(data_slice, dimorders, self.dxs) if sum(dimorders)>0 else data_slice
-    
+
+    def get_data_slice(self, name, obs_inds, domain): # raw values of an observable component on a domain
+        source = self.data_dict[name]
+        if isinstance(source, StreamingSource):
+            return self.read_window(source, domain.min_corner, domain.max_corner, obs_inds, domain)
+        return get_slice(source[..., *obs_inds], domain)
+
+    def read_window(self, source, min_corner, max_corner, obs_inds, domain): # read and record the bytes read
+        bytes_read = source.bytes_read
+        window = source.read(min_corner, max_corner, obs_inds)
+        self.domain_bytes_read[domain] = self.domain_bytes_read.get(domain, 0) + source.bytes_read - bytes_read
+        return window
+
+    def get_chunks(self): # storage chunk shape of the (first chunked) streamed data, over the grid dimensions
+        for source in self.data_dict.values():
+            if isinstance(source, StreamingSource) and source.chunks is not None:
+                return source.chunks[:self.n_dimensions]
+        return None
+
+    def eval_window(self, source, obs_inds, dimorders, domain, acc=6): # slice of a whole-field derivative
+        # differentiate the domain plus a halo as wide as in diff_chunked: stencils of the points kept never reach the
+        # edges of the window, so the result is the same as slicing the derivative of the whole field
+        halos = [2 * (order + acc) if order > 0 else 0 for order in dimorders]
+        min_corner = [max(0, c - halo) for c, halo in zip(domain.min_corner, halos)]
+        max_corner = [min(n - 1, c + halo) for c, halo, n in zip(domain.max_corner, halos, source.shape)]
+        window = diff(self.read_window(source, min_corner, max_corner, obs_inds, domain), dimorders, self.dxs, acc)
+        return window[tuple(slice(lo - w_lo, hi - w_lo + 1)
+                            for lo, hi, w_lo in zip(domain.min_corner, domain.max_corner, min_corner))]
+
+    def find_derivative_ancestor(self, lattice_key, dimorders): # cached field to differentiate further, if any
+        # finite difference stencils along different axes commute, but (because of the boundaries) e.g. applying the
+        # 1st derivative stencil twice isn't the same as the 2nd derivative stencil, so along each axis the ancestor
+        # must have either the full order or none of it
+        domain = lattice_key[2]
+        best_orders, best_slice = None, None
+        for orders, prime in self.derivative_index.get(lattice_key, dict()).items():
+            if all(order in (0, target) for order, target in zip(orders, dimorders)) and list(orders) != dimorders:
+                if best_orders is None or sum(orders) > sum(best_orders):
+                    data_slice = self.field_dict.get((prime, domain)) if (prime, domain) in self.field_dict else None
+                    if data_slice is not None:
+                        best_orders, best_slice = orders, data_slice
+        return best_orders, best_slice
+
+    def get_diff_method(self): # resolve diff_method='auto' based on how much of the grid the domains cover
+        if self.diff_method != 'auto':
+            return self.diff_method
+        # per-domain differentiation costs about the total domain volume, whole-field differentiation the grid volume
+        grid_volume = np.prod(next(iter(self.data_dict.values())).shape[:self.n_dimensions])
+        domain_volume = sum(np.prod(domain.shape) for domain in self.domains or [])
+        return 'global' if domain_volume >= self.global_coverage * grid_volume else 'findiff'
+
+    def get_global_field(self, name, obs_inds, orders): # finite difference derivative of an observable on the full grid
+        key = ('findiff', name, tuple(obs_inds), tuple(orders))
+        if key not in self.global_fields:
+            data_arr = self.data_dict[name][..., *obs_inds]
+            if self.global_field_dir is None:
+                self.global_fields[key] = diff_chunked(data_arr, orders, self.dxs, chunk_size=self.global_chunk_size)
+            else: # write to a .npy file chunk by chunk and keep it memory-mapped (reused by later sessions)
+                filename = os.path.join(self.global_field_dir,
+                                        hashlib.sha1((repr(key) + self.data_hash()).encode()).hexdigest() + '.npy')
+                if not os.path.exists(filename):
+                    os.makedirs(self.global_field_dir, exist_ok=True)
+                    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+                    out = np.lib.format.open_memmap(tmp_filename, mode='w+', dtype=np.float64, shape=data_arr.shape)
+                    diff_chunked(data_arr, orders, self.dxs, chunk_size=self.global_chunk_size, out=out)
+                    out.flush()
+                    del out
+                    os.replace(tmp_filename, filename)
+                self.global_fields[key] = np.load(filename, mmap_mode='r')
+        return self.global_fields[key]
+
+    def get_periodic_dims(self):
+        return list(range(self.n_dimensions-1)) if self.periodic_dims is None else list(self.periodic_dims)
+
+    def get_spectral_field(self, name, obs_inds, orders): # spectral derivative of an observable on the full grid
+        key = ('spectral', name, tuple(obs_inds), tuple(orders))
+        if key not in self.global_fields:
+            data_arr = self.data_dict[name][..., *obs_inds]
+            if sum(orders) == 0:
+                return data_arr
+            axes = self.get_periodic_dims()
+            transform_key = ('fft', name, tuple(obs_inds), ())
+            if transform_key not in self.global_fields: # transform each field only once
+                self.global_fields[transform_key] = np.fft.rfftn(data_arr, axes=axes)
+            self.global_fields[key] = spectral_diff(data_arr, orders, self.dxs, axes=axes,
+                                                    transform=self.global_fields[transform_key])
+        return self.global_fields[key]
+
+    def precompute_global_fields(self, primes): # fill global_fields with the whole-field derivatives of primes
+        diff_method = self.get_diff_method()
+        for prime in primes:
+            name, obs_inds, dimorders = self.prime_orders(prime)
+            if sum(dimorders) == 0:
+                continue
+            if diff_method == 'global' and not isinstance(self.data_dict[name], StreamingSource):
+                self.get_global_field(name, obs_inds, dimorders)
+            elif diff_method == 'spectral':
+                self.get_spectral_field(name, obs_inds, self.split_spectral_orders(dimorders)[0])
+
+    def make_shared_descriptor(self, pool):
+        # whole-field derivatives are computed once, here, and shared with the workers like data_dict (instead of
+        # being recomputed by every worker); memory-mapped ones (global_field_dir) are attached from their files
+        self.precompute_global_fields(set().union(*(plan.primes() for plan in self.plans.values())))
+        descriptor = super().make_shared_descriptor(pool)
+        descriptor.global_fields = {key: SharedArrayRef(shape=arr.shape, dtype=arr.dtype.str, filename=arr.filename)
+                                    if isinstance(arr, np.memmap) else pool.share(arr)
+                                    for key, arr in self.global_fields.items() if key[0] != 'fft'}
+        descriptor.derivative_index = dict() # (refers to primes in the field_dict of this process)
+        descriptor.domain_bytes_read = dict()
+        return descriptor
+
+    def attach_shared_arrays(self):
+        super().attach_shared_arrays()
+        self.global_fields = {key: arr.attach() if isinstance(arr, SharedArrayRef) else arr
+                              for key, arr in self.global_fields.items()}
+
+    def eval_settings(self):
+        return super().eval_settings() | {'diff_acc': 6, # accuracy of diff in eval_prime
+                                          'diff_method': self.get_diff_method(), 'periodic_dims': self.periodic_dims}
+
     def make_libraries(self, **kwargs):
         self.libs = dict()
         terms = generate_terms_to(observables=self.observables, **kwargs)
@@ -56,12 +238,26 @@ class SRDataset(AbstractDataset):
         for name in self.data_dict:
             if names is None or name in names:
                 self.scale_dict[name] = dict()
+                if isinstance(self.data_dict[name], StreamingSource): # one pass over the data, a chunk at a time
+                    stats = RunningStats()
+                    for chunk in self.data_dict[name].iter_time_chunks():
+                        stats.update(chunk)
+                    self.scale_dict[name]['mean'] = stats.rms
+                    self.scale_dict[name]['std'] = stats.std
+                    continue
                 # if these are vector quantities the results could be wonky in the unlikely
                 # case a vector field is consistently aligned with one of the axes
                 self.scale_dict[name]['mean'] = np.mean(
                     np.linalg.norm(self.data_dict[name]) / np.sqrt(self.data_dict[name].size))
                 self.scale_dict[name]['std'] = np.std(self.data_dict[name])
 
+    @classmethod
+    def from_files(cls, path, names=None, **kwargs): # SRDataset streaming its data from HDF5 or chunk directories
+        # the grid shape (world_size) is taken from the first array, over as many dimensions as there are dxs
+        data_dict = open_data_dict(path, names)
+        world_size = np.array(next(iter(data_dict.values())).shape[:len(kwargs['dxs'])])
+        return cls(world_size=world_size, data_dict=data_dict, **kwargs)
+
     def get_char_size(self, term):
         # return characteristic size of a library term
         product = 1
@@ -0,0 +1,60 @@
+import numpy as np
+
+class CellList(object): # uniform-grid spatial hash of a set of points, for finding the points near a box
+    def __init__(self, points, cell_size):
+        # points: (n, d) array of positions; cell_size: edge length of the (hyper)cubic cells
+        # only occupied cells are stored: points are sorted by cell id and cells are found by binary search, so
+        # memory is O(n) however fine the grid is
+        self.points = points
+        self.cell_size = cell_size
+        self.origin = points.min(axis=0) if len(points) else np.zeros(points.shape[1])
+        cells = np.floor((points - self.origin) / cell_size).astype(np.int64)
+        self.grid_shape = cells.max(axis=0) + 1 if len(points) else np.ones(points.shape[1], dtype=np.int64)
+        cell_ids = np.ravel_multi_index(tuple(cells.T), tuple(self.grid_shape))
+        self.order = np.argsort(cell_ids, kind='stable') # point indices sorted by cell
+        self.sorted_ids = cell_ids[self.order]
+
+    def query_box(self, min_corner, max_corner, radius): # sorted indices of points within radius of a box
+        # distance to the box is the max norm distance used by IntegrationDomain.distance
+        min_corner, max_corner = np.asarray(min_corner), np.asarray(max_corner)
+        lo = np.maximum(np.floor((min_corner - radius - self.origin) / self.cell_size).astype(np.int64), 0)
+        hi = np.minimum(np.floor((max_corner + radius - self.origin) / self.cell_size).astype(np.int64),
+                        self.grid_shape - 1)
+        if np.any(hi < lo):
+            return np.zeros(0, dtype=np.int64)
+        cell_ids = np.ravel_multi_index(tuple(np.meshgrid(*[np.arange(l, h + 1) for l, h in zip(lo, hi)],
+                                                          indexing='ij')), tuple(self.grid_shape)).ravel()
+        starts = np.searchsorted(self.sorted_ids, cell_ids, side='left')
+        lengths = np.searchsorted(self.sorted_ids, cell_ids, side='right') - starts
+        # concatenation of the ranges [start, start + length) of every cell
+        offsets = np.cumsum(lengths) - lengths
+        candidates = self.order[np.repeat(starts - offsets, lengths) + np.arange(np.sum(lengths))]
+        pts = self.points[candidates]
+        distances = np.max(np.maximum(0, np.maximum(min_corner - pts, pts - max_corner)), axis=1, initial=0)
+        return np.sort(candidates[distances <= radius])
+
+class NeighborLists(object): # CSR storage of index arrays, looked up by key like a dict of arrays
+    def __init__(self, keys, index_arrays):
+        self.key_index = {key: i for i, key in enumerate(keys)}
+        lengths = np.array([len(indices) for indices in index_arrays], dtype=np.int64)
+        self.indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        self.indices = np.concatenate(index_arrays).astype(np.int64) if index_arrays else np.zeros(0, dtype=np.int64)
+
+    def __getitem__(self, key):
+        i = self.key_index[key]
+        return self.indices[self.indptr[i]:self.indptr[i+1]]
+
+    def __contains__(self, key):
+        return key in self.key_index
+
+    def __len__(self):
+        return len(self.key_index)
+
+    def keys(self):
+        return self.key_index.keys()
+
+    def items(self):
+        return ((key, self[key]) for key in self.key_index)
+
+    def __repr__(self):
+        return f"NeighborLists({len(self)} lists, {len(self.indices)} indices)"
@@ -1,5 +1,7 @@
+from collections import OrderedDict
+
 import numpy as np
-from numba import jit, float64, uint64, prange, int64, uint8
+from numba import jit, float64, uint64, prange, int64, uint8, get_num_threads
 from numba_kdtree import KDTree
 from math import gamma
 
@@ -18,21 +20,21 @@ def gaussian_coarse_grain2d(points: float64[:, :],
     """
     This function implements a gaussian coarse graining algorithm. Heavily inspired by the scipy implementation at
     https://github.com/scipy/scipy/blob/main/scipy/stats/_stats.pyx
-    :param points: the data points to estimate from in 2 dimensions. Shape (n, 2).
+    :param points: the data points to estimate from in d dimensions. Shape (n, d).
     :param values: the multivariate values associated with the data points. (n,)
-    :param xi: the coordinates to evaluate the estimate at in 2 dimensions. Shape (m, 2).
+    :param xi: the coordinates to evaluate the estimate at in d dimensions. Shape (m, d).
     :param sigma: the gaussian kernel width (standard deviation). Float.
     :return: the coarse grained data at the coordinates xi. Shape (m,).
     """
     n: uint64 = points.shape[0]  # number of data points
-    d: uint64 = 2  # dimension of the data points
+    d: uint64 = points.shape[1]  # dimension of the data points
     m: uint64 = xi.shape[0]  # number of evaluation points
 
     points_: float64[n, d] = points / sigma  # the scaled data points
     xi_: float64[m, d] = xi / sigma  # the scaled evaluation points
 
     estimate: float64[m] = np.zeros(m)  # the estimate at the evaluation points
-    norm: float64 = 1 / (2 * np.pi) / (sigma * sigma)  # the normalization factor of the gaussian kernel
+    norm: float64 = (2 * np.pi * sigma * sigma) ** (-d / 2)  # the normalization factor of the gaussian kernel
 
     for i in prange(n):
         local_estimate: float64[m] = np.zeros(m)  # intermediate results for each thread
@@ -65,15 +67,15 @@ def kd_gaussian_coarse_grain2d(points: float64[:, :],
     """
     This function implements a gaussian coarse graining algorithm. Uses a KDTree to only consider nearby points.
     Heavily inspired by the scipy implementation at https://github.com/scipy/scipy/blob/main/scipy/stats/_stats.pyx
-    :param points: the data points to estimate from in 2 dimensions. Shape (n, 2).
+    :param points: the data points to estimate from in d dimensions. Shape (n, d).
     :param values: the multivariate values associated with the data points. (n,)
-    :param xi: the coordinates to evaluate the estimate at in 2 dimensions. Shape (m, 2).
+    :param xi: the coordinates to evaluate the estimate at in d dimensions. Shape (m, d).
     :param sigma: the gaussian kernel width (standard deviation). Float.
     :param cutoff: the cutoff radius for the KDTree in units of sigma. Float.
     :return: the coarse grained data at the coordinates xi. Shape (m,).
     """
     n: uint64 = points.shape[0]  # number of data points
-    d: uint64 = 2  # dimension of the data points
+    d: uint64 = points.shape[1]  # dimension of the data points
     m: uint64 = xi.shape[0]  # number of evaluation points
 
     points_: float64[n, d] = points / sigma  # the scaled data points
@@ -85,7 +87,7 @@ def kd_gaussian_coarse_grain2d(points: float64[:, :],
     xi_: float64[m, d] = xi / sigma  # the scaled evaluation points
 
     estimate: float64[m] = np.zeros(m)  # the estimate at the evaluation points
-    norm: float64 = 1 / (2 * np.pi) / (sigma * sigma)  # the normalization factor of the gaussian kernel
+    norm: float64 = (2 * np.pi * sigma * sigma) ** (-d / 2)  # the normalization factor of the gaussian kernel
 
     for j in prange(m):
         neighbors: uint64[:] = tree.query_radius(xi_[j, :], cutoff)[0]
@@ -118,9 +120,9 @@ def coarse_grain_time_slices(points: float64[:, :, :],
     """
     This function implements a gaussian coarse graining algorithm. Uses a KDTree to only consider nearby points.
     Heavily inspired by the scipy implementation at https://github.com/scipy/scipy/blob/main/scipy/stats/_stats.pyx
-    :param points: the data points to estimate from in 2 dimensions + time. Shape (n, 2, t).
+    :param points: the data points to estimate from in d dimensions + time. Shape (n, d, t).
     :param values: the multivariate values associated with the data points. (n, t)
-    :param xi: the coordinates to evaluate the estimate at in 2 dimensions. Shape (m, 2).
+    :param xi: the coordinates to evaluate the estimate at in d dimensions. Shape (m, d).
     :param sigma: the gaussian kernel width (standard deviation). Float.
     :param cutoff: the cutoff radius for the KDTree in units of sigma. Float.
     :return: the coarse grained data at the coordinates xi. Shape (m, t).
@@ -155,9 +157,9 @@ def verlet_coarse_grain_time_slices(points: float64[:, :, :],
     """
     This function implements a gaussian coarse graining algorithm. Uses a KDTree to only consider nearby points.
     Heavily inspired by the scipy implementation at https://github.com/scipy/scipy/blob/main/scipy/stats/_stats.pyx
-    :param points: the data points to estimate from in 2 dimensions + time. Shape (n, 2, t).
+    :param points: the data points to estimate from in d dimensions + time. Shape (n, d, t).
     :param values: the multivariate values associated with the data points. (n, t)
-    :param xi: the coordinates to evaluate the estimate at in 2 dimensions. Shape (m, 2).
+    :param xi: the coordinates to evaluate the estimate at in d dimensions. Shape (m, d).
     :param sigma: the gaussian kernel width (standard deviation). Float.
     :param cutoff: the cutoff radius for the KDTree in units of sigma. Float.
     :param h: How often the verlet list is updated. uint64.
@@ -166,6 +168,7 @@ def verlet_coarse_grain_time_slices(points: float64[:, :, :],
     n: uint64 = points.shape[0]  # number of data points
     m: uint64 = xi.shape[0]  # number of evaluation points
     t: uint64 = points.shape[2]  # number of time slices
+    d: uint64 = points.shape[1]  # dimension of the data points
 
     points_: float64[:, :, :] = points / sigma  # the scaled data points
     xi_: float64[:, :] = xi / sigma  # the scaled evaluation points
@@ -173,7 +176,7 @@ def verlet_coarse_grain_time_slices(points: float64[:, :, :],
     leaf_size: uint64 = np.floor(np.log2(n))  # the leaf_size of the KDTree (log2(n) is a good heuristic)
 
     estimate: float64[m, t] = np.zeros((m, t))  # the estimate at the evaluation points
-    norm: float64 = 1 / (2 * np.pi) / (sigma * sigma)  # the normalization factor of the gaussian kernel
+    norm: float64 = (2 * np.pi * sigma * sigma) ** (-d / 2)  # the normalization factor of the gaussian kernel
     for k in np.arange(int64(0), t, h):
         # build the KDTree
         # print("Building KDTree for time slice " + str(k) + " of " + str(t) + " time slices.")
@@ -214,6 +217,18 @@ def int_pow(x: float64, n: uint8) -> float64:
     return r
 
 
+@jit(nopython=True, cache=True, nogil=True)
+def poly_kernel_norm(d, order, distance):
+    """
+    Integral of the polynomial kernel (a^2 - r^2)^n / a^(2n) over the ball of radius a in d dimensions.
+    :param d: the dimension. Int.
+    :param order: the order of the polynomial (n in the formula). Int.
+    :param distance: size of the kernel (a in the formula). Float.
+    :return: a^d pi^(d/2) Gamma(n+1) / Gamma(n+1+d/2), i.e. pi a^2 / (n+1) for d = 2. Float.
+    """
+    return distance ** d * np.pi ** (d / 2) * gamma(order + 1) / gamma(order + 1 + d / 2)
+
+
 # [TODO] same changes as Gaussian
 @jit(
     signature_or_function="float64[:](float64[:, :], float64[:], float64[:, :], uint8, float64)",
@@ -234,15 +249,15 @@ def kd_poly_coarse_grain2d(points: float64[:, :],
     This function implements a polynomial coarse graining algorithm. Uses a KDTree to only consider nearby points.
     Heavily inspired by the scipy implementation at https://github.com/scipy/scipy/blob/main/scipy/stats/_stats.pyx
     Kernel shape is (a^2- r^2)^n for r < a, 0 otherwise.
-    :param points: the data points to estimate from in 2 dimensions. Shape (n, 2).
+    :param points: the data points to estimate from in d dimensions. Shape (n, d).
     :param values: the multivariate values associated with the data points. (n,)
-    :param xi: the coordinates to evaluate the estimate at in 2 dimensions. Shape (m, 2).
+    :param xi: the coordinates to evaluate the estimate at in d dimensions. Shape (m, d).
     :param order: the order of the polynomial to use (n in the formula). uint8.
     :param distance: size of the kernel (a in the formula). Float.
     :return: the coarse grained data at the coordinates xi. Shape (m,).
     """
     n: uint64 = points.shape[0]  # number of data points
-    d: uint64 = 2  # dimension of the data points
+    d: uint64 = points.shape[1]  # dimension of the data points
     m: uint64 = xi.shape[0]  # number of evaluation points
 
     points_: float64[n, d] = points / distance  # the scaled data points
@@ -252,7 +267,7 @@ def kd_poly_coarse_grain2d(points: float64[:, :],
     xi_: float64[m, d] = xi / distance  # the scaled evaluation points
 
     estimate: float64[m] = np.zeros(m)  # the estimate at the evaluation points
-    norm: float64 = np.pi * distance * distance / (1 + order)  # the normalization factor of the polynomial kernel
+    norm: float64 = poly_kernel_norm(d, order, distance)  # the normalization factor of the polynomial kernel
     for j in prange(m):
         neighbors: uint64[:] = tree.query_radius(xi_[j, :], 1)[0]
         for i in neighbors:
@@ -281,9 +296,9 @@ def poly_coarse_grain_time_slices(points: float64[:, :, :],
                                   distance: float64) -> float64[:, :]:
     """
     Applies the polynomial coarse graining algorithm to a time series.
-    :param points: the data points to estimate from in 2 dimensions. Shape (n, 2).
+    :param points: the data points to estimate from in d dimensions. Shape (n, d).
     :param values: the multivariate values associated with the data points. (n,)
-    :param xi: the coordinates to evaluate the estimate at in 2 dimensions. Shape (m, 2).
+    :param xi: the coordinates to evaluate the estimate at in d dimensions. Shape (m, d).
     :param order: the order of the polynomial to use (n in the formula). uint8.
     :param distance: size of the kernel (a in the formula). Float.
     :return: the coarse grained data at the coordinates xi. Shape (m,).
@@ -296,3 +311,201 @@ def poly_coarse_grain_time_slices(points: float64[:, :, :],
         estimate[:, h] = kd_poly_coarse_grain2d(points[:, :, h], values[:, h], xi[:, :], order, distance)
 
     return estimate
+
+
+class SpatialIndexCache(object): # LRU cache of scaled particle positions and their KD-tree, one entry per time slice
+    # the positions at time t are the same for every coarse-grained prime and every domain containing t, so the
+    # tree is built once and shared by all of them
+    def __init__(self, max_bytes=2**28):
+        self.max_bytes = max_bytes # memory limit of the positions and trees (None = unbounded); the last one is kept
+        self.entries = OrderedDict()
+        self.entry_bytes = dict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, points, t, distance): # -> (points at time t divided by distance, KDTree of those)
+        # points: particle positions, shape (n, d, t); distance: kernel size (a in the polynomial kernel)
+        key = (int(t), float(distance))
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        points_ = np.ascontiguousarray(points[:, :, t] / distance, dtype=np.float64)
+        # the leaf_size of the KDTree (log2(n) is a good heuristic)
+        tree = KDTree(points_, leafsize=max(1, int(np.floor(np.log2(max(len(points_), 2))))))
+        self.entries[key] = (points_, tree)
+        # the tree holds its own copy of the positions and the particle order (its nodes, about 1/leafsize of that,
+        # are not counted)
+        self.entry_bytes[key] = points_.nbytes + tree.data.nbytes + tree.idx.nbytes
+        self.nbytes += self.entry_bytes[key]
+        while self.max_bytes is not None and self.nbytes > self.max_bytes and len(self.entries) > 1:
+            self.nbytes -= self.entry_bytes.pop(self.entries.popitem(last=False)[0])
+        return points_, tree
+
+    def clear(self):
+        self.entries.clear()
+        self.entry_bytes.clear()
+        self.nbytes = 0
+
+    def __getstate__(self): # don't ship trees to other processes
+        state = self.__dict__.copy()
+        state['entries'], state['entry_bytes'], state['nbytes'] = OrderedDict(), dict(), 0
+        return state
+
+    def __repr__(self):
+        return f"SpatialIndexCache({len(self.entries)} entries, {self.nbytes} bytes, hits={self.hits}, misses={self.misses})"
+
+
+@jit(nopython=True, cache=True, fastmath=True, parallel=True, nogil=True)
+def kd_poly_coarse_grain_multi(points_, tree, values, xi, order, distance):
+    """
+    Polynomial coarse graining of several weight vectors (e.g. observable products) in a single neighbor pass, using
+    a prebuilt KDTree (see SpatialIndexCache). Same kernel as kd_poly_coarse_grain2d.
+    :param points_: the data points divided by distance in d dimensions. Shape (n, d).
+    :param tree: the KDTree of points_.
+    :param values: the values associated with the data points, one column per weight vector. Shape (n, k).
+    :param xi: the coordinates to evaluate the estimate at in d dimensions. Shape (m, d).
+    :param order: the order of the polynomial to use (n in the formula). Int.
+    :param distance: size of the kernel (a in the formula). Float.
+    :return: the coarse grained data at the coordinates xi for each weight vector. Shape (m, k).
+    """
+    m = xi.shape[0]  # number of evaluation points
+    k = values.shape[1]  # number of weight vectors
+    xi_ = xi / distance  # the scaled evaluation points
+
+    estimate = np.zeros((m, k))  # the estimate at the evaluation points
+    norm = poly_kernel_norm(xi.shape[1], order, distance)  # the normalization factor of the polynomial kernel
+    for j in prange(m):
+        neighbors = tree.query_radius(xi_[j, :], 1.0)[0]
+        for i in neighbors:
+            kernel = int_pow(1 - np.sum((points_[i, :] - xi_[j, :]) * (points_[i, :] - xi_[j, :])), order)
+            for c in range(k):
+                estimate[j, c] += values[i, c] * kernel
+
+    return estimate / norm
+
+
+def poly_coarse_grain_products(index_cache, points, times, values, xi, order, distance):
+    """
+    Applies the polynomial coarse graining algorithm to several observable products over a time series: for each
+    time slice, the kernel weight of every (evaluation point, neighbor) pair is computed once and accumulated into
+    all products (see kd_poly_coarse_grain_multi).
+    :param index_cache: SpatialIndexCache providing the KD-tree of each time slice.
+    :param points: the data points in d dimensions + time (all times). Shape (n, d, T).
+    :param times: the time indices to evaluate. Length t.
+    :param values: the values associated with the data points for each product. Shape (n, n_products, t).
+    :param xi: the coordinates to evaluate the estimate at in d dimensions. Shape (m, d).
+    :param order: the order of the polynomial to use (n in the formula). Int.
+    :param distance: size of the kernel (a in the formula). Float.
+    :return: the coarse grained data at the coordinates xi. Shape (m, n_products, t).
+    """
+    estimate = np.zeros((xi.shape[0], values.shape[1], len(times)))
+    for h, t in enumerate(times):
+        estimate[:, :, h] = kd_poly_coarse_grain_multi(*index_cache.get(points, t, distance),
+                                                       np.ascontiguousarray(values[:, :, h]), xi, order, distance)
+    return estimate
+
+
+@jit(nopython=True, cache=True, fastmath=True, parallel=True, nogil=True)
+def scatter_poly_coarse_grain_multi(points, values, grid_min, shape, resolution, order, distance, n_chunks):
+    """
+    Polynomial coarse graining by deposition: each particle adds its kernel to the grid points it reaches, which is
+    cheaper than gathering neighbors for every grid point when the grid is denser than the particles. Same kernel
+    and result as kd_poly_coarse_grain_multi on the grid coordinates (grid_min + index) / resolution.
+    :param points: the data points in d dimensions. Shape (n, d).
+    :param values: the values associated with the data points, one column per weight vector. Shape (n, k).
+    :param grid_min: integer coordinates of the first grid point (in units of 1/resolution). Shape (d,).
+    :param shape: number of grid points along each dimension. Shape (d,).
+    :param resolution: grid points per unit length. Float.
+    :param order: the order of the polynomial to use (n in the formula). Int.
+    :param distance: size of the kernel (a in the formula). Float.
+    :param n_chunks: number of thread-private copies of the grid (e.g. the number of threads). Int.
+    :return: the coarse grained data at the grid points (flattened in C order, like np.mgrid(...).ravel()) for each
+    weight vector. Shape (m, k).
+    """
+    n, d = points.shape  # number and dimension of the data points
+    k = values.shape[1]  # number of weight vectors
+    m = 1  # number of grid points
+    for axis in range(d):
+        m *= shape[axis]
+    strides = np.ones(d, dtype=np.int64)  # of the flattened (C order) grid
+    for axis in range(d - 2, -1, -1):
+        strides[axis] = strides[axis + 1] * shape[axis + 1]
+    reach = distance * resolution  # kernel radius in grid units
+
+    # thread-private accumulators: particles are dealt out to n_chunks chunks, each with its own copy of the grid
+    # (n_chunks is an argument, as get_num_threads() would keep the kernel from being cached)
+    accumulators = np.zeros((n_chunks, m, k))
+    for c in prange(n_chunks):
+        lo = np.empty(d, dtype=np.int64)  # box of grid points within reach of the particle
+        hi = np.empty(d, dtype=np.int64)
+        index = np.empty(d, dtype=np.int64)
+        for i in range(c, n, n_chunks):
+            empty = False
+            for axis in range(d):
+                p = points[i, axis] * resolution - grid_min[axis]  # position in grid units
+                lo[axis] = max(0, int(np.ceil(p - reach)))
+                hi[axis] = min(shape[axis] - 1, int(np.floor(p + reach)))
+                empty = empty or hi[axis] < lo[axis]
+            if empty:
+                continue
+            index[:] = lo
+            while True:
+                r2 = 0.0
+                flat = 0
+                for axis in range(d):
+                    delta = (points[i, axis] - (grid_min[axis] + index[axis]) / resolution) / distance
+                    r2 += delta * delta
+                    flat += index[axis] * strides[axis]
+                if r2 <= 1:
+                    kernel = int_pow(1 - r2, order)
+                    for v in range(k):
+                        accumulators[c, flat, v] += values[i, v] * kernel
+                # next grid point of the box (last axis fastest)
+                axis = d - 1
+                while axis >= 0 and index[axis] == hi[axis]:
+                    index[axis] = lo[axis]
+                    axis -= 1
+                if axis < 0:
+                    break
+                index[axis] += 1
+
+    estimate = np.zeros((m, k))  # reduction of the thread-private results
+    for j in prange(m):
+        for c in range(n_chunks):
+            for v in range(k):
+                estimate[j, v] += accumulators[c, j, v]
+    norm = poly_kernel_norm(d, order, distance)  # the normalization factor of the polynomial kernel
+    return estimate / norm
+
+
+def scatter_poly_coarse_grain_products(points, times, values, grid_min, shape, resolution, order, distance,
+                                       max_bytes=2**26):
+    """
+    Scatter counterpart of poly_coarse_grain_products (see scatter_poly_coarse_grain_multi). Products are deposited
+    a few at a time so that the thread-private accumulators stay within max_bytes.
+    :param points: the data points in d dimensions + time (all times). Shape (n, d, T).
+    :param times: the time indices to evaluate. Length t.
+    :param values: the values associated with the data points for each product. Shape (n, n_products, t).
+    :param grid_min: integer coordinates of the first grid point (in units of 1/resolution). Shape (d,).
+    :param shape: number of grid points along each dimension. Shape (d,).
+    :param resolution: grid points per unit length. Float.
+    :param order: the order of the polynomial to use (n in the formula). Int.
+    :param distance: size of the kernel (a in the formula). Float.
+    :param max_bytes: memory limit of the thread-private accumulators. Int.
+    :return: the coarse grained data at the grid points. Shape (m, n_products, t).
+    """
+    grid_min, shape = np.asarray(grid_min, dtype=np.int64), np.asarray(shape, dtype=np.int64)
+    m, n_products = int(np.prod(shape)), values.shape[1]
+    n_chunks = max(1, min(points.shape[0], get_num_threads(), max_bytes // (8 * m)))
+    tile = max(1, min(n_products, max_bytes // (8 * m * n_chunks)))  # products per deposition pass
+    estimate = np.zeros((m, n_products, len(times)))
+    for h, t in enumerate(times):
+        points_t = np.ascontiguousarray(points[:, :, t])
+        for start in range(0, n_products, tile):
+            estimate[:, start:start+tile, h] = scatter_poly_coarse_grain_multi(
+                points_t, np.ascontiguousarray(values[:, start:start+tile, h]), grid_min, shape, float(resolution),
+                order, distance, n_chunks)
+    return estimate
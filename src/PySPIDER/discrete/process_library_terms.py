@@ -1,14 +1,14 @@
-import warnings
-
 import numpy as np
 import scipy
+import scipy.special
 from scipy.stats._stats import gaussian_kernel_estimate
 # uncomment the next line if it isn't broken for you
-from PySPIDER.discrete.coarse_grain_utils import coarse_grain_time_slices, poly_coarse_grain_time_slices
+from PySPIDER.discrete.coarse_grain_utils import coarse_grain_time_slices, poly_coarse_grain_products, \
+    scatter_poly_coarse_grain_products, SpatialIndexCache
 
 from PySPIDER.commons.process_library_terms import *
 from PySPIDER.commons.library import *
-from PySPIDER.commons.utils import regex_find
+from PySPIDER.discrete.cell_list import CellList, NeighborLists
 from PySPIDER.discrete.convolution import *
 from PySPIDER.discrete.library import *
 
@@ -20,18 +20,36 @@ class SRDataset(AbstractDataset):  # structures all data associated with a given
     # be an integer
     cg_res: float
     deltat: float
-    domain_neighbors: dict[[IntegrationDomain, float], int] = None # indices of neighbors of each ID at given time
+    domain_neighbors: NeighborLists = None # (domain, t) -> indices of the particles near the domain at time t
     cutoff: float=6 # how many std deviations to cut off Gaussian weight functions at
     rho_scale: float=1 # density rescaling factor
+    # memory limit of the KD-trees (and scaled positions) of the time slices kept in spatial_index (None = unbounded);
+    # (2 * spatial dimensions + 1) * 8 bytes per particle and time slice
+    spatial_index_bytes: int = 2**28
+    # coarse-grain every product in the libraries at once when one of them is needed on a domain
+    batch_coarse_graining: bool = True
+    # 'gather' (sum over the neighbors of each grid point), 'scatter' (each particle deposits its kernel on the grid)
+    # or 'auto' (whichever get_coarse_graining_method estimates to be cheaper on the domain)
+    coarse_graining_method: str = 'auto'
+    # memory limit of cg_fields, which holds batch coarse-grained products until the primes using them are built
+    cg_cache_bytes: int = 2**28
     #field_dict: dict[tuple[Any], np.ndarray[float]] = None # storage of computed coarse-grained quantities: (cgp, dims, domains) -> array
     
     #cgps: set[CoarseGrainedPrimitive] = None # list of coarse-grained primitives involved
 
+    shared_array_attributes = ('particle_pos', 'scaled_pts')
+
     def __post_init__(self):
         super().__post_init__()
         self.scaled_sigma = self.kernel_sigma * self.cg_res
         self.scaled_pts = self.particle_pos * self.cg_res
         self.dxs = [1 / self.cg_res] * (self.n_dimensions - 1) + [float(self.deltat)]  # spacings of sampling grid
+        self.field_dict.pin(self.rho_prime()) # find_scales needs rho on every domain
+        self.spatial_index = SpatialIndexCache(self.spatial_index_bytes) # KD-trees shared by all primes/domains
+        # (cgp, order, domain) -> coarse-grained product (before derivatives), filled by batched coarse-graining
+        self.cg_fields = FieldCache(max_bytes=self.cg_cache_bytes)
+        self.cg_pending = dict() # (cgp, order, domain) -> primes of cgp not built on domain yet
+        self.cg_batched = set() # (order, domain) on which all coarse_grained_products were already evaluated
         #self.rho_scale = self.particle_pos.shape[0]/np.prod(self.world_size[:-1]) # mean number density
         #self.cgps = set()
 
@@ -53,7 +71,7 @@ class SRDataset(AbstractDataset):  # structures all data associated with a given
                 case _:
                     raise NotImplemented
 
-    def make_domains(self, ndomains, domain_size, pad=0):
+    def make_domains(self, ndomains, domain_size, pad=0, sampler=None):
         self.domains = []
         scaled_dims = [int(s * self.cg_res) for s in domain_size[:-1]] + [domain_size[-1]]  # self.interp_factor *
         scaled_world_size = [int(s * self.cg_res) for s in self.world_size[:-1]] + [
@@ -62,69 +80,154 @@ class SRDataset(AbstractDataset):  # structures all data associated with a given
         self.pad = pad # record the padding used
         pads = [np.ceil(pad * self.cg_res) for s in domain_size[:-1]] + [0] 
         self.domain_size = scaled_dims
-        for i in range(ndomains):
-            min_corner = []
-            max_corner = []
-            # define domains on the *scaled* grid
-            for (L, max_lim, pad_i) in zip(scaled_dims, scaled_world_size, pads):
-                #print(pad_i, max_lim - (L+pad_i) + 1)
-                num = np.random.randint(pad_i, max_lim - (L + pad_i) + 1)
-                min_corner.append(num)
-                max_corner.append(num + L - 1)
+        # define domains on the *scaled* grid
+        allowed_starts = [range(int(pad_i), int(max_lim - (L + pad_i) + 1))
+                          for (L, max_lim, pad_i) in zip(scaled_dims, scaled_world_size, pads)]
+        for min_corner in self.get_domain_sampler(sampler).sample(ndomains, allowed_starts, scaled_dims):
+            max_corner = [num + L - 1 for num, L in zip(min_corner, scaled_dims)]
             # (potentially) less messy if we fix beginning/end of time extent to the actual measurements
             # time_fraction = min_corner % self.interp_factor
             # min_corner -= time_fraction
             # max_corner -= time_fraction
             self.domains.append(IntegrationDomain(min_corner, max_corner))
 
+    @staticmethod
+    def rho_prime():
+        return LibraryPrime(derivative=DerivativeOrder(torder=0, x_derivatives=()),
+                            derivand=CoarseGrainedProduct(observables=()))
+
+    def prime_cost(self, prime): # coarse-graining dominates the cost of a discrete prime
+        return (1 + len(prime.derivand.observables)) * self.cutoff ** (self.n_dimensions - 1) + prime.nderivs
+
+    def eval_settings(self):
+        return super().eval_settings() | {'kernel_sigma': self.kernel_sigma, 'cg_res': self.cg_res,
+                                          'deltat': self.deltat, 'cutoff': self.cutoff, 'rho_scale': self.rho_scale}
+
     def find_domain_neighbors(self):
-        # list of indices corresponding to particles needed to compute quantities on each domain at each t
-        self.domain_neighbors = dict()
+        # array of indices corresponding to particles needed to compute quantities on each domain at each t
+        # (particles within cutoff * sigma of the domain, see IntegrationDomain.distance), using one cell list per
+        # time slice with cells of that size
+        radius = self.scaled_sigma * self.cutoff
+        keys_by_time = dict()
         for domain in self.domains:
             for t in domain.times:
-                self.domain_neighbors[domain, t] = []
-                for i, pt in enumerate(self.scaled_pts):
-                    dist = domain.distance(pt[:, t])
-                    if dist <= self.scaled_sigma * self.cutoff:
-                        self.domain_neighbors[domain, t].append(i)
+                keys_by_time.setdefault(t, []).append(domain)
+        keys, index_arrays = [], []
+        for t, domains in sorted(keys_by_time.items()):
+            cell_list = CellList(self.scaled_pts[:, :, t], radius)
+            for domain in domains:
+                keys.append((domain, t))
+                index_arrays.append(cell_list.query_box(domain.min_corner[:-1], domain.max_corner[:-1], radius))
+        self.domain_neighbors = NeighborLists(keys, index_arrays)
+
+    def make_shared_descriptor(self, pool):
+        descriptor = super().make_shared_descriptor(pool)
+        descriptor.cg_fields = FieldCache(max_bytes=self.cg_cache_bytes) # don't ship coarse-grained fields
+        descriptor.cg_pending = dict()
+        descriptor.cg_batched = set()
+        return descriptor
+
+    def make_library_matrices(self, *args, **kwargs):
+        try:
+            super().make_library_matrices(*args, **kwargs)
+        finally: # coarse-grained products are only kept while the primes of a domain are being built
+            self.cg_fields.clear()
+            self.cg_pending.clear()
+            self.cg_batched.clear()
+
+    def release_domain(self, domain): # drop the coarse-grained products left over on domain
+        for key in [key for key in self.cg_fields.keys() if key[2] == domain]:
+            del self.cg_fields[key]
+            self.cg_pending.pop(key, None)
+        self.cg_batched = {key for key in self.cg_batched if key[1] != domain}
+
+    def coarse_grained_products(self): # every (index-assigned) CoarseGrainedProduct in the plans and rho -> its primes
+        plan_keys = tuple(self.plans.keys())
+        if getattr(self, 'cgps_memo', (None,))[0] != plan_keys:
+            cgps = {self.rho_prime().derivand: {self.rho_prime()}}
+            for plan in self.plans.values():
+                for prime in plan.primes():
+                    cgps.setdefault(prime.derivand, set()).add(prime)
+            self.cgps_memo = (plan_keys, cgps)
+        return self.cgps_memo[1]
+
+    def particle_values(self, cgp, domain): # product of the observables of cgp per particle, shape (n, t)
+        values = np.ones((self.particle_pos.shape[0], len(domain.times)), dtype=np.float64)
+        for obs in cgp.observables:
+            obs_inds = map(lambda idx: idx.value, obs.indices)
+            values *= self.data_dict[obs.string][:, *obs_inds, domain.times].astype(np.float64)
+        return values
+
+    def get_coarse_graining_method(self, domain, distance): # resolve coarse_graining_method = 'auto'
+        if self.coarse_graining_method != 'auto':
+            return self.coarse_graining_method
+        # both directions evaluate the kernel on the same (particle, grid point) pairs, of which there are about
+        # grid points * particle density * kernel volume; scattering also makes a pass over all particles, gathering
+        # runs a tree query per grid point and is slower per pair (costs in units of one particle visit, as measured
+        # on the numba kernels)
+        n_particles = self.particle_pos.shape[0]
+        particle_density = n_particles / np.prod(self.world_size[:-1])
+        n_grid_points = np.prod(domain.shape[:-1]) # = grid density (cg_res^d) * domain volume
+        d = len(domain.shape) - 1
+        kernel_volume = np.pi ** (d / 2) / scipy.special.gamma(d / 2 + 1) * distance ** d # volume of the d-ball
+        pairs = n_grid_points * particle_density * kernel_volume
+        return 'scatter' if n_particles + 2 * pairs < 100 * n_grid_points + 7 * pairs else 'gather'
+
+    def get_coarse_grained(self, cgp, domain, order=4): # polynomial-kernel coarse-grained cgp on domain
+        # with batch_coarse_graining (and cache_primes), the first miss on a domain evaluates all coarse_grained_products
+        # on it in one neighbor traversal and keeps them in cg_fields until their primes are built (see
+        # release_coarse_grained); later misses (after evictions) and batches that don't fit in cg_cache_bytes only
+        # evaluate cgp; treat the result as read-only
+        batch = self.batch_coarse_graining and self.cache_primes
+        data_slice = self.cg_fields.get((cgp, order, domain)) if batch else None
+        if data_slice is not None:
+            return data_slice
+        products = self.coarse_grained_products()
+        fits = self.cg_cache_bytes is None or 8 * len(products) * np.prod(domain.shape) <= self.cg_cache_bytes
+        cgps = [cgp] + [other for other in products if other != cgp] \
+            if batch and fits and (order, domain) not in self.cg_batched else [cgp]
+        sigma = self.scaled_sigma / self.cg_res
+        min_corner = domain.min_corner[:-1]
+        max_corner = domain.max_corner[:-1]
+        grid = np.mgrid[tuple(slice(lo, hi + 1) for lo, hi in zip(min_corner, max_corner))]
+        xi = np.stack([(coords / self.cg_res).ravel() for coords in grid], axis=1) # (m, d), in C order
+        dist = sigma*np.sqrt(3+2*order)
+        values = np.stack([self.particle_values(other, domain) for other in cgps], axis=1) # (n, n_products, t)
+        if self.get_coarse_graining_method(domain, dist) == 'scatter':
+            estimate = scatter_poly_coarse_grain_products(self.particle_pos, domain.times, values, min_corner,
+                                                          domain.shape[:-1], self.cg_res, order, dist)
+        else: # the KD-tree of each time slice comes from (and stays in) spatial_index
+            estimate = poly_coarse_grain_products(self.spatial_index, self.particle_pos, domain.times, values, xi,
+                                                  order, dist)
+        if len(cgps) > 1:
+            self.cg_batched.add((order, domain))
+        if batch: # (derivatives of the same product need it again)
+            for i, other in enumerate(cgps):
+                self.cg_fields.put((other, order, domain), estimate[:, i, :].reshape(domain.shape), cost=len(cgps))
+                self.cg_pending[other, order, domain] = set(products.get(other, ()))
+        return estimate[:, 0, :].reshape(domain.shape)
+
+    def release_coarse_grained(self, prime, domain, order=4): # prime is built on domain: drop unneeded products
+        key = (prime.derivand, order, domain)
+        pending = self.cg_pending.get(key)
+        if pending is None:
+            return
+        pending.discard(prime)
+        if not pending or key not in self.cg_fields: # (or it was evicted)
+            del self.cg_pending[key]
+            if key in self.cg_fields:
+                del self.cg_fields[key]
 
     def eval_prime(self, prime: LibraryPrime, domain: IntegrationDomain, experimental: bool = True, order: int = 4):
         # experimental: bool = True,
         cgp = prime.derivand
-        if self.n_dimensions != 3:
-            if experimental:
-                warnings.warn("Experimental method only implemented for 2D+1 systems")
         data_slice = np.zeros(domain.shape)
         if experimental:
-            pt_pos = self.scaled_pts[:, :, domain.times] / self.cg_res  # Unscaled positions
-            pt_pos = np.float64(pt_pos)
-            weights = np.ones_like(pt_pos[:, 0, :], dtype=np.float64)
-            for obs in cgp.observables:
-                obs_inds = map(lambda idx: idx.value, obs.indices)
-                #if obs.rank == 0:
-                #    data = self.data_dict[obs.string][:, 0, domain.times]
-                #else:
-                data = self.data_dict[obs.string][:, *obs_inds, domain.times]
-                weights *= data.astype(np.float64)
-                #obs_dim_ind += obs.rank
-            sigma = self.scaled_sigma / self.cg_res
-            min_corner = domain.min_corner[:-1]
-            max_corner = domain.max_corner[:-1]
-            xx, yy = np.mgrid[
-                         min_corner[0]:(max_corner[0] + 1),
-                         min_corner[1]:(max_corner[1] + 1)
-                         ]
-            xi = np.vstack([
-                (xx / self.cg_res).ravel(),
-                (yy / self.cg_res).ravel(),
-            ]).T
-            dist = sigma*np.sqrt(3+2*order)
-            # uncomment if this isn't broken for you
-            data_slice = poly_coarse_grain_time_slices(pt_pos, weights, xi, order, dist) 
-            data_slice = data_slice.reshape(domain.shape)
+            data_slice = self.get_coarse_grained(cgp, domain, order)
+            self.release_coarse_grained(prime, domain, order)
         else:
-            if self.domain_neighbors is None:
-                self.find_domain_neighbors()
+            if self.domain_neighbors is None or (domain, domain.min_corner[-1]) not in self.domain_neighbors:
+                self.find_domain_neighbors() # (domains may have changed since)
             for t in range(domain.shape[-1]):
                 time_slice = np.zeros(domain.shape[:-1])
                 t_shifted = t + domain.min_corner[-1]
@@ -145,19 +248,19 @@ class SRDataset(AbstractDataset):  # structures all data associated with a given
                     sigma = self.scaled_sigma ** 2 / (self.cg_res ** 2)
                     # Check scipy version. If it's lower than 1.10, use inverse_covariance, otherwise use Cholesky
                     if int(scipy.__version__.split(".")[0]) <= 1 and int(scipy.__version__.split(".")[1]) < 10:
-                        inv_cov = np.eye(2) / sigma
+                        inv_cov = np.eye(self.n_dimensions - 1) / sigma
                     else:
-                        inv_cov = np.eye(2) * sigma
+                        inv_cov = np.eye(self.n_dimensions - 1) * sigma
                         inv_cov = np.linalg.cholesky(inv_cov[::-1, ::-1]).T[::-1, ::-1]
                     min_corner = domain.min_corner[:-1]
                     max_corner = domain.max_corner[:-1]
-                    xx, yy = np.mgrid[min_corner[0]:(max_corner[0] + 1), min_corner[1]:(max_corner[1] + 1)]
-                    positions = np.vstack([(xx / self.cg_res).ravel(), (yy / self.cg_res).ravel()]).T
+                    grid = np.mgrid[tuple(slice(lo, hi + 1) for lo, hi in zip(min_corner, max_corner))]
+                    positions = np.stack([(coords / self.cg_res).ravel() for coords in grid], axis=1)
                     density = gaussian_kernel_estimate['double'](pt_pos, weights[:, None], positions, inv_cov,
                                                                  np.float64)
-                    time_slice = np.reshape(density[:, 0], xx.shape)
+                    time_slice = np.reshape(density[:, 0], grid.shape[1:])
 
-                    data_slice[..., t] = time_slice / (self.cg_res ** 2)
+                    data_slice[..., t] = time_slice / (self.cg_res ** (self.n_dimensions - 1))
                 else:
                     for i in self.domain_neighbors[domain, t_shifted]:
                         pt_pos = self.scaled_pts[i, :, t_shifted]
@@ -194,7 +297,7 @@ class SRDataset(AbstractDataset):  # structures all data associated with a given
             data_slice *= self.cg_res ** (self.n_dimensions - 1)  # need to scale rho by res^(# spatial dims)!
 
         # rescale prime to rho=1 units
-        data_slice /= self.rho_scale
+        data_slice = data_slice / self.rho_scale
         
         # evaluate derivatives
         orders = prime.derivative.get_spatial_orders()
@@ -220,12 +323,9 @@ class SRDataset(AbstractDataset):  # structures all data associated with a given
         self.scale_dict['rho']['mean'] = self.particle_pos.shape[0] / np.prod(self.world_size[:-1]) / self.rho_scale
         #self.scale_dict['rho']['mean'] = 1
 
-        #print(self.field_dict.keys())
-        all_cgps = [key[0] for key in self.field_dict.keys()]
-        rho_matches = regex_find(all_cgps, r'ρ')
-        rho_ind = next(rho_matches)[0]
-        rho = all_cgps[rho_ind]
-        all_rho_data = np.dstack([self.field_dict[rho, domain] for domain in self.domains])
+        # rho is pinned in field_dict, but may still be missing (e.g. cache_primes=False or parallel evaluation)
+        rho = self.rho_prime()
+        all_rho_data = np.dstack([self.get_field(rho, domain) for domain in self.domains])
         rho_std = np.std(all_rho_data)
         #print(all_rho_data)
         #rho_std = np.std(np.dstack([self.cg_dict[rho_cgp, (), domain] for domain in self.domains]))